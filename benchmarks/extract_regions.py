@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compares the per-label np.where scan with extract_regions for growing object counts.
+Run from the repository root: python benchmarks/extract_regions.py
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gui  # gui has to be imported before elk to resolve their import cycle
+from elk import extract_regions
+
+from skimage.measure import regionprops
+
+image_size = 2048
+object_counts = [10, 100, 1000, 4000]
+repeats = 3
+
+
+def make_label_image(object_n, size=image_size):
+    label_img = np.zeros((size, size), dtype=np.int64)
+    grid = int(np.ceil(np.sqrt(object_n)))
+    step = size // grid
+    radius = max(step // 3, 1)
+    yy, xx = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    disk = yy ** 2 + xx ** 2 <= radius ** 2
+
+    for n in range(object_n):
+        row = (n // grid) * step + step // 2
+        col = (n % grid) * step + step // 2
+        window = label_img[row - radius:row + radius + 1, col - radius:col + radius + 1]
+        window[disk[:window.shape[0], :window.shape[1]]] = n + 1
+
+    return label_img
+
+
+def per_label_where(label_img):
+    return [(np.where(label_img == region.label), region.bbox, region.centroid)
+            for region in regionprops(label_img)]
+
+
+def timed(function, label_img):
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(label_img)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == '__main__':
+    print('image {0}x{0}, best of {1}'.format(image_size, repeats))
+    print('{:>8} {:>14} {:>18} {:>9}'.format('objects', 'np.where [s]', 'extract_regions [s]', 'speedup'))
+    for object_n in object_counts:
+        label_img = make_label_image(object_n)
+        old = timed(per_label_where, label_img)
+        new = timed(extract_regions, label_img)
+        print('{:>8} {:>14.3f} {:>18.3f} {:>8.1f}x'.format(object_n, old, new, old / new))
@@ -6,9 +6,9 @@ Author: David Bunk
 """
 
 from PyQt5.QtCore import QAbstractItemModel, QModelIndex, Qt, \
-    QItemSelectionModel, pyqtSignal, pyqtSlot, QThread, QObject
+    QItemSelectionModel, pyqtSignal, pyqtSlot, QThread, QObject, QTimer
 from PyQt5.QtWidgets import QMainWindow, QApplication, QWidget, QSizePolicy, \
-    QFileDialog, QListView, QColumnView, QMessageBox, QFrame
+    QFileDialog, QListView, QColumnView, QMessageBox, QFrame, QProgressDialog
 
 from gui import Ui_MainWindow
 
@@ -17,9 +17,15 @@ from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt5 import FigureCanvasBase
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT
 from matplotlib.figure import Figure
+from matplotlib.colors import ListedColormap
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
 from matplotlib.widgets import LassoSelector
 
 from scipy.ndimage.morphology import binary_erosion, binary_fill_holes
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 from shapely.geometry import LineString, MultiPoint, MultiLineString, LinearRing, Point, collection
 from shapely.ops import split, nearest_points
@@ -27,17 +33,31 @@ from shapely.ops import split, nearest_points
 from skimage.filters import threshold_otsu
 from skimage.segmentation import clear_border
 from skimage.morphology import remove_small_objects, binary_closing
-from skimage.measure import label, regionprops
+from skimage.measure import label
 from skimage.io import imread, imsave
 from skimage.draw import polygon
 
 import pickle
+import hashlib
+import shutil
+import json
+import uuid
+import io
 import time
+import threading
 import sys, os
 import warnings
 import numpy as np
 from glob import glob
-from copy import copy
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
 
 ###################################################### Initialisation
 
@@ -45,6 +65,23 @@ init_class_n = 2
 autosave_pause = 90
 otsu_min_size = 500
 zoom_buffer = 50
+image_cache_size = 2 * 1024 ** 3  # bytes of decoded images kept in memory
+pool_workers = None  # None uses all cores
+preseg_cache_dir = os.path.join(os.path.expanduser('~'), '.easylabelkit', 'preseg_cache')
+preseg_cache_size = 2 * 1024 ** 3  # bytes on disk
+journal_compact_n = 50  # autosave checkpoints before the journal is folded into the manifest
+prefetch_next = 3
+prefetch_prev = 1
+pool_start_method = 'spawn'
+tile_threshold = 1024 ** 3  # bytes, larger TIFFs are memory mapped or read tile by tile instead of decoded whole
+downsample_band = 64 * 1024 ** 2  # bytes of source rows read at once when building display levels
+preseg_tiled = 256 * 1024 ** 2  # bytes, larger and memory mapped images are presegmented tile by tile
+preseg_tile = 2048  # rows and columns per presegmentation tile
+preseg_format = 3  # layout of cached segmentations, stale cache entries are ignored
+export_manifest = 'export_manifest.json'  # label hashes of the last export, kept in the export folder
+coco_filename = 'coco.json'
+dataset_index = 'dataset.json'  # bucket files and per sample slots of a dataset export
+dataset_bucket = 256  # pixels, dataset images are padded to multiples of this in both dimensions
 
 ###################################################### Window class
 
@@ -77,6 +114,11 @@ class VisionGui(QMainWindow, Ui_MainWindow):
         self.backend.ask_redraw.connect(self.ask_redraw)
         self.backendthread.start()
 
+        self.prefetcher = Prefetcher()
+        self.prefetchthread = QThread()
+        self.prefetcher.moveToThread(self.prefetchthread)
+        self.prefetchthread.start()
+
         self.savetimer = SaveTimer(pause_duration=autosave_pause)
         self.timingthread = QThread()
         self.savetimer.moveToThread(self.timingthread)
@@ -114,8 +156,13 @@ class VisionGui(QMainWindow, Ui_MainWindow):
         self.actionRemove_class.triggered.connect(self.remove_class)
         self.actionSwitch_outlines_on_off.triggered.connect(self.toggle_outline)
 
+        self.actionClear_cache = self.menuSettings.addAction('Clear presegmentation cache')
+        self.actionClear_cache.triggered.connect(preseg_cache.clear)
+
         self.data.class_n_changed.connect(self.change_class_n)
         self.data.loadingfailed.connect(self.loading_error)
+        self.data.exportfailed.connect(self.export_error)
+        self.data.savingfailed.connect(self.saving_error)
 
         self.loadimagebutton.clicked.connect(self.get_data)
         self.rmimagebutton.clicked.connect(self.remove_image)
@@ -154,7 +201,10 @@ class VisionGui(QMainWindow, Ui_MainWindow):
             self.objects_list.setModel(self.data.treemodel)
 
     def autosave(self):
-        self.data.save_project(filename='./label_autosave')
+        if self.mpl_widget.lasso_active:
+            QTimer.singleShot(1000, self.autosave)
+            return
+        self.data.autosave()
 
     @pyqtSlot(int)
     def ask_redraw(self, case):
@@ -201,6 +251,26 @@ class VisionGui(QMainWindow, Ui_MainWindow):
 
         box.exec_()
 
+    def export_error(self, count):
+        box = QMessageBox()
+        box.setBaseSize(400, 150)
+        box.setIcon(QMessageBox.Warning)
+        box.setStandardButtons(QMessageBox.Ok)
+        box.setText("Not all labels could be exported.")
+        box.setWindowTitle("Export failed.")
+        box.setInformativeText(str(count) + ' label images could not be written.')
+        box.exec_()
+
+    def saving_error(self):
+        box = QMessageBox()
+        box.setBaseSize(400, 150)
+        box.setIcon(QMessageBox.Warning)
+        box.setStandardButtons(QMessageBox.Ok)
+        box.setText("The project could not be saved.")
+        box.setWindowTitle("Saving failed.")
+        box.setInformativeText('Check that the project folder is writable and try again.')
+        box.exec_()
+
     def move_object_up(self):
         if self.currentImage is None:
             return
@@ -227,7 +297,7 @@ class VisionGui(QMainWindow, Ui_MainWindow):
         else:
             curr_index = self.currentObject.row()
 
-        if curr_index == self.data.treemodel.rootItem.child(self.currentImage.row()).childCount() - 1:
+        if curr_index == self.data.treemodel.fetch_image(self.currentImage.row()).childCount() - 1:
             return
 
         tempobj = self.data.treemodel.index(curr_index + 1, 0, self.currentImage)
@@ -276,23 +346,23 @@ class VisionGui(QMainWindow, Ui_MainWindow):
         if self.currentObject is None:
             if len(self.data.files[self.currentImage.row()].objects) == 0:
                 self.data.files[parent.row()].objects.append(Object(0))
-                self.currentObject = self.data.treemodel.index(self.data.treemodel.rootItem.child(
+                self.currentObject = self.data.treemodel.index(self.data.treemodel.fetch_image(
                     self.currentImage.row()).childCount() - 1, 0, self.currentImage)
             else:
-                childcount = self.data.treemodel.rootItem.child(self.currentImage.row()).childCount() - 1
-                name = self.data.treemodel.rootItem.child(self.currentImage.row()).child(childcount).data(0).split(' ')[-1]
+                childcount = self.data.treemodel.fetch_image(self.currentImage.row()).childCount() - 1
+                name = self.data.treemodel.fetch_image(self.currentImage.row()).child(childcount).data(0).split(' ')[-1]
                 try:
                     name, suffix = name.split('.')
                 except ValueError:
                     pass
 
                 self.data.files[parent.row()].objects.append(Object(name))
-                self.currentObject = self.data.treemodel.index(self.data.treemodel.rootItem.child(
+                self.currentObject = self.data.treemodel.index(self.data.treemodel.fetch_image(
                     self.currentImage.row()).childCount() - 1, 0, self.currentImage)
                 self.oldObject = None
                 self.switch_overview_button()
         else:
-            name = self.data.treemodel.rootItem.child(self.currentImage.row()).child(
+            name = self.data.treemodel.fetch_image(self.currentImage.row()).child(
                 self.currentObject.row()).data(0).split(' ')[-1]
             try:
                 name, suffix = name.split('.')
@@ -502,8 +572,11 @@ class VisionGui(QMainWindow, Ui_MainWindow):
             if model_index is not self.currentImage:
                 self.currentImage = model_index
                 self.currentObject = None
+                self.data.treemodel.fetch_image(model_index.row())
+                self.prefetcher.record(self.data.files[model_index.row()])
                 try:
                     self.mpl_widget.set_image(self.data.files[model_index.row()], self.outline_switch)
+                    self.prefetcher.request(self.prefetcher.neighbours(self.data.files, model_index.row()))
                 except ValueError:
                     box = QMessageBox()
                     box.setBaseSize(400, 150)
@@ -534,10 +607,7 @@ class VisionGui(QMainWindow, Ui_MainWindow):
     def toggle_outline(self):
         self.switch_outline_button()
         if self.currentImage is not None:
-            self.mpl_widget.set_image(self.data.files[self.currentImage.row()], self.outline_switch)
-            if self.currentObject is not None and self.overview_switch:
-                self.mpl_widget.zoom()
-                self.mpl_widget.set_object(self.data.files[self.currentImage.row()].objects[self.currentObject.row()])
+            self.mpl_widget.set_outlines(self.outline_switch)
 
     def closeEvent(self, event):
         box = QMessageBox()
@@ -559,6 +629,9 @@ class Data(QObject):
     """wow"""
     class_n_changed = pyqtSignal(int)
     loadingfailed = pyqtSignal(int)
+    exportfailed = pyqtSignal(int)
+    savingfailed = pyqtSignal()
+    checkpoint = pyqtSignal(object, object)
 
     def __init__(self):
         super(QObject, self).__init__()
@@ -573,10 +646,26 @@ class Data(QObject):
         self.listmodel = ItemModel(init_class_n, 'list')
 
         self.dialog = FileDialog()
+        self.stores = {}
+        self.pools = []
+
+        self.writer = ProjectWriter()
+        self.writerthread = QThread()
+        self.writer.moveToThread(self.writerthread)
+        self.checkpoint.connect(self.writer.write)
+        self.writerthread.start()
+        self.import_error = False
+        self.import_results = {}
+        self.import_next = 0
+        self.export_errors = 0
+        self.export_state = None
+        self.coco_state = None
+        self.dataset_state = None
 
     def get_data(self):
-        error = False
-        success = False
+        if self.pool_running():
+            return False
+
         self.paths = self.dialog.open_multiple_images()
         if self.paths == [] or self.paths is None:
             return False
@@ -637,29 +726,84 @@ class Data(QObject):
         elif load_preseg == 2:
             preseg = False
 
+        jobs = []
         for n, file in enumerate(self.paths):
-            try:
-                if load_preseg == 1:
-                    sample = Sample(file, presegmentation=preseg[n], presegpath=presegpaths[n])
-                elif load_preseg == 2:
-                    sample = Sample(file, presegmentation=preseg)
-                else:
-                    sample = Sample(file)
-                success = True
-            except:
-                error = True
-                continue
+            if load_preseg == 1:
+                jobs.append((file, preseg[n], presegpaths[n]))
+            elif load_preseg == 2:
+                jobs.append((file, preseg, None))
+            else:
+                jobs.append((file, None, None))
 
-            self.files.append(sample)
+        self.import_error = False
+        self.import_results = {}
+        self.import_next = 0
+        self.start_pool(build_sample, jobs, 'Loading images...',
+                        self.add_sample, self.import_failed, self.import_finished)
 
-        self.treemodel = ItemModel(self, 'tree')
+        return True
+
+    def add_sample(self, n, sample):
+        # samples finish out of order, they are held back until every earlier one arrived or failed
+        self.import_results[n] = sample
+        self.flush_samples()
 
-        if error:
+    def flush_samples(self, everything=False):
+        while self.import_results:
+            if self.import_next not in self.import_results:
+                if not everything:
+                    return
+                self.import_next = min(self.import_results)
+            sample = self.import_results.pop(self.import_next)
+            self.import_next += 1
+            if sample is not None:
+                self.files.append(sample)
+                self.treemodel.add_image(sample)
+
+    def import_failed(self, n):
+        self.import_error = True
+        self.import_results[n] = None
+        self.flush_samples()
+
+    def import_finished(self, cancelled):
+        self.flush_samples(everything=True)
+        preseg_cache.evict()
+        if self.import_error:
             self.loadingfailed.emit(1)
 
-        return success
+    def start_pool(self, function, jobs, text, on_result, on_failed, on_finished):
+        worker = PoolWorker(function, jobs)
+        thread = QThread()
+        worker.moveToThread(thread)
+
+        progress = QProgressDialog(text, 'Cancel', 0, len(jobs))
+        progress.setWindowTitle(text)
+        # import and export results are kept on Data, a second pool would overwrite them
+        progress.setWindowModality(Qt.ApplicationModal)
+        progress.setMinimumDuration(0)
+        progress.setValue(0)
+        progress.canceled.connect(worker.cancel, Qt.DirectConnection)
+
+        pool = (worker, thread, progress)
+        worker.result.connect(on_result)
+        worker.failed.connect(on_failed)
+        worker.progress.connect(progress.setValue)
+        worker.finished.connect(on_finished)
+        worker.finished.connect(progress.reset)
+        worker.finished.connect(thread.quit)
+        thread.started.connect(worker.run)
+
+        self.pools = [p for p in self.pools if not p[1].isFinished()]
+        self.pools.append(pool)
+        thread.start()
+
+    def pool_running(self):
+        return any(not thread.isFinished() for _, thread, _ in self.pools)
 
     def export_labels(self):
+        if self.pool_running():
+            return
+
         path = self.dialog.export()
 
         if path == '':
@@ -669,45 +813,291 @@ class Data(QObject):
         box.setIcon(QMessageBox.Warning)
         box.setText("Please choose label format.")
         box.setWindowTitle("Please choose label format.")
-        box.setInformativeText("Do you want to save the labels as images or binaries?.")
+        box.setInformativeText("Do you want to save the labels as images, binaries, images with instance maps, "
+                               "as one COCO file or as a memory mapped dataset?")
         box.addButton('Image', QMessageBox.AcceptRole)
         box.addButton('Binary', QMessageBox.RejectRole)
-
-        label_is_image = box.exec_()
-
-        if label_is_image == 0 or label_is_image == 1:
+        box.addButton('Instances', QMessageBox.ActionRole)
+        box.addButton('COCO', QMessageBox.ActionRole)
+        box.addButton('Dataset', QMessageBox.ActionRole)
+
+        label_format = box.exec_()
+
+        if label_format == 4:
+            self.export_dataset(path)
+        elif label_format == 3:
+            self.export_coco(os.path.join(path, coco_filename))
+        elif label_format in (0, 1, 2):
+            # only samples whose labels changed since the last export into this folder are written again
+            manifest = read_export_manifest(path)
+            paths = set(file.path for file in self.files)
+            for name, entry in list(manifest.items()):
+                if entry['path'] not in paths:
+                    for filename in entry.get('files', [name]):
+                        try:
+                            os.remove(os.path.join(path, filename))
+                        except OSError:
+                            pass
+                    del manifest[name]
+
+            # Image and Instances both write <image name>, a job outdates every entry listing a file it writes
+            owners = {}
+            for name, entry in manifest.items():
+                for filename in entry.get('files', [name]):
+                    owners.setdefault(filename, set()).add(name)
+
+            jobs = []
+            entries = []
             for file in self.files:
-                image = file.image
-                label_img = np.zeros_like(image, dtype=np.uint8)
-
-                for obj in file.objects:
-                    if obj.x is not None and len(obj.x) > 5:
-                        x, y = polygon(obj.x, obj.y)
-                        if self.max_class == 1:
-                            label_img[y, x] = 255
-                        else:
-                            label_img[y, x] = obj.classtype + 1
-                    else:
-                        if obj.preseg is not None:
-                            if self.max_class == 1:
-                                label_img[obj.preseg] = 255
-                            else:
-                                label_img[obj.preseg] = obj.classtype + 1
-
-                if label_is_image == 0:
-                    with warnings.catch_warnings():
-                        warnings.simplefilter("ignore")
-                        imsave(os.path.join(path, file.name), label_img)
+                stem = file.name.split('.')[0]
+                if label_format == 1:
+                    files = [stem + '.npy']
                 else:
-                    np.save(os.path.join(path, file.name.split('.')[0] + '.npy'), label_img)
+                    files = [file.name]
+                if label_format == 2:
+                    files += [stem + '_instances.tif', stem + '.json']
+                filenames = [os.path.join(path, name) for name in files]
+
+                name = files[-1]
+                entry = manifest.get(name)
+                previous = None if entry is None else entry['hash']
+                # unloaded samples are read and hashed by the worker, which skips them if nothing changed
+                if file.loaded_objects is None:
+                    objects = file.shard
+                else:
+                    objects = freeze_objects(file.objects)
+                    if previous == label_digest(objects, self.max_class) and all(os.path.isfile(f) for f in filenames):
+                        continue
+                    previous = None
+                for filename in files:
+                    for owner in owners.pop(filename, ()):
+                        # files of the outdated entry that this job does not rewrite would be left stale and untracked
+                        for stale in manifest.pop(owner, {}).get('files', []):
+                            if stale not in files:
+                                try:
+                                    os.remove(os.path.join(path, stale))
+                                except OSError:
+                                    pass
+                manifest.pop(name, None)
+                jobs.append((file.path, file.shape, objects, self.max_class, previous) + tuple(filenames))
+                entries.append((name, {'path': file.path, 'files': files}))
+
+            self.export_errors = 0
+            self.export_state = (path, manifest, entries)
+            if not jobs:
+                self.export_finished(False)
+                return
+            self.start_pool(export_sample, jobs, 'Exporting labels...',
+                            self.label_exported, self.export_failed, self.export_finished)
+
+    def label_exported(self, n, digest):
+        name, entry = self.export_state[2][n]
+        entry['hash'] = digest
+        self.export_state[1][name] = entry
+
+    def export_failed(self, n):
+        self.export_errors += 1
+
+    def export_finished(self, cancelled):
+        path, manifest, _ = self.export_state
+        try:
+            write_export_manifest(path, manifest)
+        except OSError:
+            self.export_errors += 1
+        if self.export_errors:
+            self.exportfailed.emit(self.export_errors)
+
+    def export_coco(self, filename):
+        # annotations are written as the pool returns them, only image entries stay in memory until the end
+        categories = [{'id': n + 1, 'name': self.class_name(n)} for n in range(self.max_class)]
+        tmpname = filename + '.' + str(os.getpid()) + '.tmp'
+        file = open(tmpname, 'w')
+        file.write('{"info": ' + json.dumps({'description': 'EasyLabelKit export'}) +
+                   ', "licenses": [], "categories": ' + json.dumps(categories) + ',\n"annotations": [\n')
+
+        jobs = []
+        first_id = 1
+        for n, sample in enumerate(self.files):
+            if sample.loaded_objects is None:
+                objects = sample.shard  # read by the worker, the objects never enter this process
+            else:
+                objects = freeze_objects(sample.objects)
+            jobs.append((sample.path, sample.name, sample.shape, objects, n + 1, first_id))
+            first_id += sample.object_count()
+
+        self.export_errors = 0
+        self.coco_state = {'file': file, 'tmpname': tmpname, 'filename': filename, 'images': [], 'empty': True}
+        self.start_pool(coco_annotations, jobs, 'Exporting COCO annotations...',
+                        self.coco_exported, self.export_failed, self.coco_finished)
+
+    def coco_exported(self, n, result):
+        image, annotations = result
+        state = self.coco_state
+        state['images'].append(image)
+        if annotations:
+            state['file'].write(annotations if state['empty'] else ',\n' + annotations)
+            state['empty'] = False
+
+    def coco_finished(self, cancelled):
+        state = self.coco_state
+        self.coco_state = None
+        file = state['file']
+        try:
+            if cancelled:
+                file.close()
+                os.remove(state['tmpname'])
+                return
+            images = sorted(state['images'], key=lambda image: image['id'])
+            file.write('\n],\n"images": ' + json.dumps(images) + '}\n')
+            file.close()
+            os.replace(state['tmpname'], state['filename'])
+        except OSError:
+            self.export_errors += 1
+        if self.export_errors:
+            self.exportfailed.emit(self.export_errors)
+
+    def export_dataset(self, folder):
+        # shapes come first so every bucket file can be created at its final size before the pool fills it
+        self.export_errors = 0
+        self.dataset_state = {'folder': folder, 'headers': {}}
+        jobs = [(sample.path,) for sample in self.files]
+        self.start_pool(image_header, jobs, 'Reading image headers...',
+                        self.header_read, self.export_failed, self.headers_finished)
+
+    def header_read(self, n, header):
+        self.dataset_state['headers'][n] = header
+
+    def headers_finished(self, cancelled):
+        state = self.dataset_state
+        if cancelled:
+            self.dataset_state = None
+            return
+
+        # images are grouped by dtype, channels and their size rounded up to dataset_bucket
+        keys = OrderedDict()
+        entries = []
+        rows = []
+        for n, sample in enumerate(self.files):
+            if n not in state['headers']:
+                continue
+            shape, dtype = state['headers'][n]
+            padded = tuple(-(-size // dataset_bucket) * dataset_bucket for size in shape[:2])
+            key = (padded, tuple(shape[2:]), dtype)
+            bucket = keys.setdefault(key, [])
+            entries.append({'name': sample.name, 'path': sample.path, 'bucket': list(keys).index(key),
+                            'slot': len(bucket), 'shape': list(shape)})
+            bucket.append(n)
+            rows.append(n)
+
+        label_dtype = np.uint8 if self.max_class <= 254 else np.uint16
+        buckets = []
+        for k, ((padded, channels, dtype), samples) in enumerate(keys.items()):
+            bucket = {'images': 'bucket' + str(k) + '_images.npy', 'labels': 'bucket' + str(k) + '_labels.npy',
+                      'shape': [len(samples)] + list(padded) + list(channels), 'dtype': dtype,
+                      'label_dtype': np.dtype(label_dtype).str}
+            try:
+                # open_memmap only extends the file, pages are written by the workers
+                np.lib.format.open_memmap(os.path.join(state['folder'], bucket['images']), mode='w+',
+                                          dtype=np.dtype(dtype), shape=tuple(bucket['shape']))
+                np.lib.format.open_memmap(os.path.join(state['folder'], bucket['labels']), mode='w+',
+                                          dtype=label_dtype, shape=(len(samples),) + padded)
+            except (OSError, ValueError):
+                self.export_errors += len(samples)
+                self.exportfailed.emit(self.export_errors)
+                self.dataset_state = None
+                return
+            buckets.append(bucket)
+
+        jobs = []
+        for entry, n in zip(entries, rows):
+            sample = self.files[n]
+            if sample.loaded_objects is None:
+                objects = sample.shard
+            else:
+                objects = freeze_objects(sample.objects)
+            bucket = buckets[entry['bucket']]
+            jobs.append((sample.path, tuple(entry['shape']), objects, self.max_class,
+                         os.path.join(state['folder'], bucket['images']),
+                         os.path.join(state['folder'], bucket['labels']), entry['slot']))
+
+        state.update({'entries': entries, 'buckets': buckets, 'failed': set()})
+        self.start_pool(dataset_sample, jobs, 'Exporting dataset...',
+                        self.dataset_written, self.dataset_failed, self.dataset_finished)
+
+    def dataset_written(self, n, slot):
+        pass
+
+    def dataset_failed(self, n):
+        self.dataset_state['failed'].add(n)
+        self.export_errors += 1
+
+    def dataset_finished(self, cancelled):
+        state = self.dataset_state
+        self.dataset_state = None
+        folder = state['folder']
+        if cancelled:
+            for bucket in state['buckets']:
+                for name in (bucket['images'], bucket['labels']):
+                    try:
+                        os.remove(os.path.join(folder, name))
+                    except OSError:
+                        pass
+            return
+
+        # failed samples keep their zero filled slot but are left out of the index
+        samples = [entry for n, entry in enumerate(state['entries']) if n not in state['failed']]
+        index = {'format': 'easylabelkit-dataset', 'version': 1, 'buckets': state['buckets'], 'samples': samples}
+        try:
+            write_atomic(os.path.join(folder, dataset_index), json.dumps(index, indent=1).encode())
+        except OSError:
+            self.export_errors += 1
+        if self.export_errors:
+            self.exportfailed.emit(self.export_errors)
+
+    def class_name(self, classtype):
+        if classtype >= self.listmodel.rootItem.childCount():
+            return 'Class ' + str(classtype + 1)
+        return str(self.listmodel.rootItem.child(classtype).data(0))
 
     def load_project(self):
-        skip = False
-        success = False
         filename = self.dialog.open_project()
         if filename == '':
             return False
 
+        if filename.endswith('.pickle'):
+            return self.load_pickle_project(filename)
+
+        skip = False
+        max_class, samples = self.store(os.path.dirname(filename)).load()
+
+        if any(sample.outlines_gen == 1 for sample in samples):
+            labelfolder = self.dialog.export()
+
+        for sample in samples:
+            if sample.outlines_gen == 2:
+                sample.defer_segmentation()
+            elif sample.outlines_gen == 1:
+                label = os.path.join(labelfolder, sample.outlines_path)
+                if not os.path.isfile(label):
+                    skip = True
+                    continue
+                sample.defer_segmentation(presegmentation=label)
+
+            self.paths.append(sample.path)
+            self.files.append(sample)
+
+        self.set_class_max(max_class)
+        self.treemodel = ItemModel(self, 'tree')
+
+        if skip:
+            self.loadingfailed.emit(3)
+
+        return len(self.files) > 0
+
+    def load_pickle_project(self, filename):
+        skip = False
+        success = False
+
         with open(filename, "rb") as path:
             projectfile = pickle.load(path)
 
@@ -736,15 +1126,7 @@ class Data(QObject):
                         preseg.append(False)
                         continue
                     else:
-                        label = os.path.join(labelfolder, sample.outlines_path)
-                    if label.endswith('.npy'):
-                        preseg.append(np.load(label))
-                    else:
-                        try:
-                            preseg.append(imread(label))
-                        except:
-                            preseg.append(False)
-                            continue
+                        preseg.append(os.path.join(labelfolder, sample.outlines_path))
         else:
             preseg = preseg_load
 
@@ -752,24 +1134,22 @@ class Data(QObject):
             if n == 0:
                 self.set_class_max(sample[0])
                 continue
-            try:
-                sample.load_image()
-            except:
-                preseg[n-1] = False
-                skip = True
-                continue
+            for obj in sample.objects:
+                if isinstance(obj.preseg, tuple):
+                    obj.set_preseg(obj.preseg)
 
             if type(preseg[n-1]) not in [int, bool]:
-                sample.get_segmentation(presegmentation=preseg[n - 1], import_objects=True)
+                sample.defer_segmentation(presegmentation=preseg[n - 1])
             elif preseg[n-1] == 2:
-                sample.get_segmentation(import_objects=True)
+                sample.defer_segmentation()
             elif not preseg[n-1]:
                 skip = True
                 continue
 
             success = True
             self.files.append(sample)
-            self.treemodel = ItemModel(self, 'tree')
+
+        self.treemodel = ItemModel(self, 'tree')
 
         if skip:
             self.loadingfailed.emit(3)
@@ -783,23 +1163,29 @@ class Data(QObject):
         if filename == '':
             return
 
-        projectfile = []
-        preseg = []
-        projectfile.append([self.max_class])
-        for sample in self.files:
-            sample_tmp = copy(sample)
-            preseg.append(sample.outlines_gen)
-            sample_tmp.image = None
-            sample_tmp.outlines = None
-            projectfile.append(sample_tmp)
+        if not filename.endswith('.elk'):
+            filename = filename + '.elk'
 
-        projectfile[0].append(preseg)
-
-        if not filename.endswith('.pickle'):
-            filename = filename + '.pickle'
-
-        with open(filename, "wb") as path:
-            pickle.dump(projectfile, path)
+        store = self.store(filename)
+        try:
+            store.save(self.files, self.max_class)
+        except OSError:
+            # snapshot already marked the samples as saved, write everything again on the next save
+            store.versions = {}
+            store.order = None
+            self.savingfailed.emit()
+
+    def autosave(self, folder='./label_autosave.elk'):
+        store = self.store(folder)
+        snapshot = store.snapshot(self.files, self.max_class)
+        if snapshot is not None:
+            self.checkpoint.emit(store, snapshot)
+
+    def store(self, folder):
+        folder = os.path.abspath(folder)
+        if folder not in self.stores:
+            self.stores[folder] = ProjectStore(folder)
+        return self.stores[folder]
 
     def set_class_max(self, upchange):
         if upchange is True:
@@ -812,55 +1198,630 @@ class Data(QObject):
             self.class_n_changed.emit(change)
 
 
+class ProjectStore:
+    # a project folder holds manifest.json, one json/npz shard pair per sample and
+    # a journal of autosave checkpoints that is folded into the manifest on compaction
+    def __init__(self, folder):
+        self.folder = folder
+        self.manifestname = os.path.join(folder, 'manifest.json')
+        self.journalname = os.path.join(folder, 'journal.jsonl')
+        self.versions = {}
+        self.order = None
+        self.journal_n = 0
+
+    def shard(self, uid):
+        return os.path.join(self.folder, 'samples', uid)
+
+    def read_manifest(self):
+        try:
+            with open(self.manifestname, 'r') as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            return {'samples': []}
+
+        entries = OrderedDict((entry['uid'], entry) for entry in manifest['samples'])
+        self.journal_n = 0
+        try:
+            with open(self.journalname, 'r') as file:
+                lines = file.readlines()
+        except OSError:
+            lines = []
+
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # a torn last line has no newline, appending to it would lose every later checkpoint
+                self.journal_n = journal_compact_n
+                break
+            for entry in record['samples']:
+                entries[entry['uid']] = entry
+            if record['order'] is not None:
+                entries = OrderedDict((uid, entries[uid]) for uid in record['order'])
+            manifest['max_class'] = record['max_class']
+            self.journal_n += 1
+
+        manifest['samples'] = list(entries.values())
+        return manifest
+
+    def load(self):
+        manifest = self.read_manifest()
+        samples = [Sample.from_manifest(entry, self.shard(entry['uid'])) for entry in manifest['samples']]
+
+        self.versions = {sample.uid: sample.version for sample in samples}
+        self.order = [sample.uid for sample in samples]
+
+        return manifest.get('max_class', init_class_n), samples
+
+    def snapshot(self, files, max_class, compact=False):
+        # runs on the GUI thread, collects what changed since the last snapshot without serializing it
+        if self.order is None or not os.path.isfile(self.manifestname) or self.journal_n >= journal_compact_n:
+            compact = True
+
+        order = [sample.uid for sample in files]
+        changed = {}
+        entries = []
+        for sample in files:
+            if self.versions.get(sample.uid) != sample.version:
+                if sample.loaded_objects is None:
+                    changed[sample.uid] = sample.shard
+                else:
+                    changed[sample.uid] = freeze_objects(sample.objects)
+                self.versions[sample.uid] = sample.version
+            if compact or sample.uid in changed:
+                entries.append(sample.manifest_entry())
+
+        if not compact and not changed and order == self.order:
+            return None
+
+        snapshot = {'compact': compact, 'max_class': max_class, 'entries': entries, 'changed': changed,
+                    'order': order if compact or order != self.order else None}
+        self.order = order
+
+        return snapshot
+
+    def write_sample(self, uid, objects, old_entry):
+        shard = self.shard(uid)
+        if isinstance(objects, str):
+            if objects != shard:
+                for suffix in ['.json', '.npz']:
+                    shutil.copyfile(objects + suffix, shard + suffix + '.tmp')
+                    os.replace(shard + suffix + '.tmp', shard + suffix)
+            return {'hash': old_entry.get('hash') if objects == shard else None}
+
+        content, arrays, digest = dump_objects(objects)
+        if old_entry.get('hash') != digest or not os.path.isfile(shard + '.npz'):
+            buffer = io.BytesIO()
+            np.savez_compressed(buffer, **arrays)
+            write_atomic(shard + '.json', content)
+            write_atomic(shard + '.npz', buffer.getvalue())
+
+        return {'hash': digest}
+
+    def write(self, snapshot):
+        if snapshot is None:
+            return
+
+        os.makedirs(os.path.join(self.folder, 'samples'), exist_ok=True)
+        changed = snapshot['changed']
+
+        if snapshot['compact']:
+            old_entries = {entry['uid']: entry for entry in self.read_manifest()['samples']}
+
+            entries = []
+            for entry in snapshot['entries']:
+                old_entry = old_entries.get(entry['uid'], {})
+                if entry['uid'] in changed:
+                    stored = self.write_sample(entry['uid'], changed[entry['uid']], old_entry)
+                else:
+                    stored = {'hash': old_entry.get('hash')}
+                stored.update(entry)
+                entries.append(stored)
+
+            manifest = {'format': 'easylabelkit', 'version': 1, 'max_class': snapshot['max_class'],
+                        'samples': entries}
+            write_atomic(self.manifestname, json.dumps(manifest, indent=1).encode())
+            if os.path.isfile(self.journalname):
+                os.remove(self.journalname)
+            self.journal_n = 0
+
+            uids = set(entry['uid'] for entry in entries)
+            for filename in glob(os.path.join(self.folder, 'samples', '*.*')):
+                if os.path.basename(filename).split('.')[0] not in uids:
+                    try:
+                        os.remove(filename)
+                    except OSError:
+                        pass
+        else:
+            entries = []
+            for entry in snapshot['entries']:
+                stored = self.write_sample(entry['uid'], changed[entry['uid']], {})
+                stored.update(entry)
+                entries.append(stored)
+
+            # a torn last line is skipped by read_manifest, which makes the next write compact
+            record = {'max_class': snapshot['max_class'], 'order': snapshot['order'], 'samples': entries}
+            with open(self.journalname, 'a') as file:
+                file.write(json.dumps(record) + '\n')
+            self.journal_n += 1
+
+    def save(self, files, max_class):
+        self.write(self.snapshot(files, max_class, compact=True))
+
+
+class ProjectWriter(QObject):
+    @pyqtSlot(object, object)
+    def write(self, store, snapshot):
+        try:
+            store.write(snapshot)
+        except OSError:
+            # write everything again on the next checkpoint
+            store.versions = {}
+            store.order = None
+
+
+class ObjectList(list):
+    # marks its sample as changed whenever objects are added, removed or replaced
+    def __init__(self, sample, objects=()):
+        list.__init__(self, objects)
+        self.sample = sample
+        for obj in self:
+            obj.owner = sample
+
+    def changed(self, objects=()):
+        for obj in objects:
+            obj.owner = self.sample
+        self.sample.touch()
+
+    def append(self, obj):
+        list.append(self, obj)
+        self.changed([obj])
+
+    def insert(self, index, obj):
+        list.insert(self, index, obj)
+        self.changed([obj])
+
+    def extend(self, objects):
+        objects = list(objects)
+        list.extend(self, objects)
+        self.changed(objects)
+
+    def pop(self, index=-1):
+        obj = list.pop(self, index)
+        self.changed()
+        return obj
+
+    def remove(self, obj):
+        list.remove(self, obj)
+        self.changed()
+
+    def clear(self):
+        list.clear(self)
+        self.changed()
+
+    def __setitem__(self, index, obj):
+        list.__setitem__(self, index, obj)
+        self.changed(obj if isinstance(index, slice) else [obj])
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self.changed()
+
+
+class TiledImage:
+    # read only array over a tiled or striped TIFF, slicing decodes just the segments the slice touches
+    def __init__(self, path):
+        self.path = path
+        with tifffile.TiffFile(path) as tif:
+            page = tif.pages[0]
+            self.shape = tuple(tif.series[0].shape)
+            self.dtype = np.dtype(page.dtype)
+            self.chunks = tuple(page.chunks[:2])
+            self.chunked = tuple(page.chunked[:2])
+        self.ndim = len(self.shape)
+        self.nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def __array__(self, dtype=None, copy=None):
+        image = self.region(0, self.shape[0], 0, self.shape[1])
+        return image if dtype is None else image.astype(dtype)
+
+    def __getitem__(self, key):
+        return sliced_region(self, key)
+
+    def region(self, row_start, row_stop, col_start, col_stop):
+        image = np.zeros((row_stop - row_start, col_stop - col_start) + self.shape[2:], dtype=self.dtype)
+        if image.size == 0:
+            return image
+
+        height, width = self.chunks
+        with tifffile.TiffFile(self.path) as tif:
+            page = tif.pages[0]
+            for row in range(row_start // height, -(-row_stop // height)):
+                for col in range(col_start // width, -(-col_stop // width)):
+                    index = row * self.chunked[1] + col
+                    data = None
+                    if page.databytecounts[index] > 0:
+                        tif.filehandle.seek(page.dataoffsets[index])
+                        data = tif.filehandle.read(page.databytecounts[index])
+                    segment, position, _ = page.decode(data, index, jpegtables=page.jpegtables)
+                    if segment is None:
+                        continue
+
+                    segment = segment[0] if self.ndim == 3 else segment[0, ..., 0]
+                    top, left = position[2], position[3]
+                    rows = slice(max(row_start, top), min(row_stop, top + segment.shape[0]))
+                    cols = slice(max(col_start, left), min(col_stop, left + segment.shape[1]))
+                    image[rows.start - row_start:rows.stop - row_start, cols.start - col_start:cols.stop - col_start] = \
+                        segment[rows.start - top:rows.stop - top, cols.start - left:cols.stop - left]
+
+        return image
+
+
+class PackedMask:
+    # read only bool array over a row packed bitmap, slicing unpacks just the window it touches
+    def __init__(self, bitmap, shape):
+        self.bitmap = bitmap
+        self.shape = tuple(shape[:2])
+        self.dtype = np.dtype(bool)
+        self.ndim = 2
+        self.nbytes = int(np.prod(self.shape))
+
+    def __array__(self, dtype=None, copy=None):
+        mask = self.region(0, self.shape[0], 0, self.shape[1])
+        return mask if dtype is None else mask.astype(dtype)
+
+    def __getitem__(self, key):
+        return sliced_region(self, key)
+
+    def region(self, row_start, row_stop, col_start, col_stop):
+        return unpack_window(self.bitmap, row_start, row_stop, col_start, col_stop)
+
+
+class ImageCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()
+        self.pinned = set()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def __contains__(self, path):
+        with self.lock:
+            return path in self.images
+
+    def get(self, path):
+        with self.lock:
+            if path in self.images:
+                self.images.move_to_end(path)
+                self.hits += 1
+                return self.images[path]
+            self.misses += 1
+
+        image = open_image(path)
+        self.put(path, image)
+        return image
+
+    def find(self, key):
+        with self.lock:
+            if key in self.images:
+                self.images.move_to_end(key)
+                return self.images[key]
+        return None
+
+    def put(self, path, image):
+        with self.lock:
+            self.discard(path)
+            self.images[path] = image
+            self.nbytes += resident_bytes(image)
+            self.evict()
+
+    def discard(self, path):
+        with self.lock:
+            image = self.images.pop(path, None)
+            if image is not None:
+                self.nbytes -= resident_bytes(image)
+
+    def evict(self):
+        with self.lock:
+            for path in list(self.images):
+                if self.nbytes <= self.max_bytes:
+                    break
+                if path not in self.pinned:
+                    self.discard(path)
+
+    def pin(self, path):
+        with self.lock:
+            self.pinned.add(path)
+
+    def unpin(self, path):
+        with self.lock:
+            self.pinned.discard(path)
+            self.evict()
+
+    def set_budget(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def clear(self):
+        with self.lock:
+            for path in list(self.images):
+                if path not in self.pinned:
+                    self.discard(path)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'images': len(self.images), 'bytes': self.nbytes}
+
+
+image_cache = ImageCache(image_cache_size)
+
+
+class PresegCache:
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.nbytes = None
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, path, presegmentation=None):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+
+        if presegmentation is not None:
+            presegmentation = np.ascontiguousarray(presegmentation)
+            digest.update(repr((presegmentation.shape, presegmentation.dtype.str)).encode())
+            digest.update(presegmentation.tobytes())
+
+        digest.update(repr((preseg_format, otsu_min_size, presegmentation is None)).encode())
+
+        return digest.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.folder, key + '.npz')
+
+    def load(self, key):
+        filename = self.filename(key)
+        try:
+            with np.load(filename) as file:
+                segmentation = dict(file)
+        except Exception:
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return segmentation
+
+    def save(self, key, segmentation):
+        os.makedirs(self.folder, exist_ok=True)
+        tmpname = self.filename(key) + '.' + str(os.getpid()) + '.tmp'
+        try:
+            with open(tmpname, 'wb') as file:
+                np.savez_compressed(file, **segmentation)
+                size = file.tell()
+            os.replace(tmpname, self.filename(key))
+        except OSError:
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+            raise
+
+        # the folder is only scanned once per process and whenever the running estimate crosses the budget,
+        # writes of other processes are caught by the evict at the end of an import
+        if self.nbytes is None:
+            self.evict()
+        elif self.nbytes + size > self.max_bytes:
+            # trimming to 3/4 of the budget leaves room for the next saves before scanning again
+            self.evict(self.max_bytes * 3 // 4)
+        else:
+            self.nbytes += size
+
+    def evict(self, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+
+        files = []
+        for filename in glob(os.path.join(self.folder, '*.npz')):
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, filename))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, filename in sorted(files):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
+        self.nbytes = total
+
+    def clear(self):
+        for filename in glob(os.path.join(self.folder, '*.npz')):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        self.nbytes = None
+
+
+preseg_cache = PresegCache(preseg_cache_dir, preseg_cache_size)
+
+
 class Sample:
     def __init__(self, path, presegmentation=None, presegpath=None):
         self.path = path
         self.name = os.path.split(self.path)[-1]
 
-        self.image = imread(path)
-        self.objects = []
+        self.uid = uuid.uuid4().hex
+        self.shard = None
+        self.shape = None
+        self.version = 0
+        self.loaded_objects = ObjectList(self)
+        self.stored_object_n = 0
         self.outlines_path = None
         self.outlines = None
         self.outlines_gen = 0
+        self.pending = None
+        self.lock = threading.Lock()
 
         self.get_segmentation(presegmentation, presegpath=presegpath)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['loaded_objects'] = list(self.objects)
+        state.pop('lock', None)
+        state.pop('pending', None)
+        return state
+
+    def __setstate__(self, state):
+        if 'objects' in state:
+            state['loaded_objects'] = state.pop('objects')
+        self.__dict__.update(state)
+        self.__dict__.setdefault('uid', uuid.uuid4().hex)
+        self.__dict__.setdefault('shard', None)
+        self.__dict__.setdefault('shape', None)
+        self.__dict__.setdefault('version', 0)
+        self.__dict__.setdefault('stored_object_n', 0)
+        if self.loaded_objects is not None:
+            self.loaded_objects = ObjectList(self, self.loaded_objects)
+        self.pending = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_manifest(cls, entry, shard):
+        sample = cls.__new__(cls)
+        sample.__setstate__({'uid': entry['uid'], 'shard': shard, 'path': entry['path'], 'name': entry['name'],
+                             'shape': tuple(entry['shape']) if entry['shape'] is not None else None,
+                             'loaded_objects': None, 'stored_object_n': entry['objects'],
+                             'outlines_path': entry['outlines_path'],
+                             'outlines': None, 'outlines_gen': entry['outlines_gen']})
+        return sample
+
+    def manifest_entry(self):
+        return {'uid': self.uid, 'path': self.path, 'name': self.name,
+                'shape': [int(n) for n in self.shape] if self.shape is not None else None,
+                'outlines_gen': self.outlines_gen, 'outlines_path': self.outlines_path,
+                'objects': self.object_count()}
+
+    def object_count(self):
+        if self.loaded_objects is None:
+            return self.stored_object_n
+        return len(self.loaded_objects)
+
+    @property
+    def objects(self):
+        if self.loaded_objects is None:
+            self.loaded_objects = ObjectList(self, load_objects(self.shard))
+        return self.loaded_objects
+
+    @objects.setter
+    def objects(self, objects):
+        self.loaded_objects = ObjectList(self, objects)
+        self.touch()
+
+    def touch(self):
+        self.version += 1
+
+    @property
+    def image(self):
+        # internal accesses are not counted, prepare counts one hit or miss per display
+        image = image_cache.find(self.path)
+        if image is None:
+            return self.load_image()
+        self.shape = image.shape
+        return image
+
+    def display_level(self, level, outlines=False):
+        # level n is the image (or outline mask) downsampled 2**n times, built on demand and kept in the image cache
+        if level == 0:
+            return self.outlines if outlines else self.image
+
+        key = (self.path, 'outlines' if outlines else 'image', level)
+        image = image_cache.find(key)
+        if image is None:
+            source = self.display_level(0, outlines)
+            if in_memory(source):
+                image = downsample(self.display_level(level - 1, outlines))
+            else:
+                # memory mapped and tiled images are streamed once per level instead of stepping through each level
+                image = downsample(source, 2 ** level)
+            image_cache.put(key, image)
+        return image
+
+    def ready(self):
+        return self.pending is None and self.path in image_cache
+
+    # under python elk.py the canvas comes from gui.py's separate import of elk,
+    # pinning through the sample uses the cache the sample actually reads from
+    def pin(self):
+        image_cache.pin(self.path)
+
+    def unpin(self):
+        image_cache.unpin(self.path)
+
+    def defer_segmentation(self, presegmentation=None):
+        # outlines are only generated once the sample is shown, see prepare
+        self.pending = [presegmentation]
+
+    def prepare(self):
+        with self.lock:
+            try:
+                if self.pending is not None:
+                    presegmentation = self.pending[0]
+                    if isinstance(presegmentation, str):
+                        presegmentation = read_label(presegmentation)
+                    self.get_segmentation(presegmentation=presegmentation, import_objects=True)
+                    self.pending = None
+                self.load_image()
+            except Exception:
+                raise ValueError('Sample ' + self.path + ' could not be loaded.')
+
     def get_segmentation(self, presegmentation=None, import_objects=False, presegpath=None):
         if presegmentation is not False:
             if presegmentation is None:
                 self.outlines_gen = 2
-                thresh = threshold_otsu(self.image)
-                binary = self.image > thresh
             else:
                 self.outlines_gen = 1
                 if not import_objects:
                     self.outlines_path = os.path.split(presegpath)[-1]
-                binary = presegmentation
-                binary[binary > 1] = 1
-
-            if binary.shape[0] != self.image.shape[0] or binary.shape[1] != self.image.shape[1]:
-                raise ValueError
 
-            binary = binary_closing(binary)
-            binary_filled = binary_fill_holes(binary)
-            cleared = clear_border(binary_filled)
-            label_img = label(cleared)
-            label_img = remove_small_objects(label_img, min_size=otsu_min_size)
-
-            pre_outlines = np.zeros_like(label_img, dtype=np.uint8)
-            pre_outlines[label_img > 0] = 1
-            pre_outlines = pre_outlines - binary_erosion(pre_outlines)
-
-            rgba_outlines = np.zeros((self.image.shape[0], self.image.shape[1], 4))
-            rgba_outlines[pre_outlines == 1] = [1, 0, 0, 1]
-            rgba_outlines[pre_outlines == 0] = [0, 0, 0, 0]
+            key = preseg_cache.key(self.path, presegmentation)
+            segmentation = preseg_cache.load(key)
+            if segmentation is None:
+                segmentation = segment(self.image, presegmentation)
+                # the cache only saves time, a sample never fails because it cannot be written
+                try:
+                    preseg_cache.save(key, segmentation)
+                except OSError as error:
+                    warnings.warn('Segmentation of ' + self.path + ' could not be cached: ' + str(error))
 
-            self.outlines = rgba_outlines
+            self.shape = tuple(segmentation['shape'])
+            height, width = self.shape[:2]
+            self.outlines = PackedMask(segmentation['outlines'], self.shape)
 
             if not import_objects:
-                regions = regionprops(label_img)
-                for n, region in enumerate(regions):
-                    bbox = np.asarray(region.bbox)
+                offsets = segmentation['offsets']
+                bits = segmentation['bits']
+                regions = zip(segmentation['bboxes'], segmentation['centroids'])
+                for n, (bbox, centroid) in enumerate(regions):
+                    preseg = Mask((int(bbox[0]), int(bbox[1])), (int(bbox[2] - bbox[0]), int(bbox[3] - bbox[1])),
+                                  bits[offsets[n]:offsets[n + 1]])
+                    bbox = np.array(bbox)
 
                     if bbox[0] - zoom_buffer >= 0:
                         bbox[0] -= zoom_buffer
@@ -868,12 +1829,12 @@ class Sample:
                         bbox[2] += (zoom_buffer - bbox[0])
                         bbox[0] = 0
 
-                    if bbox[2] + zoom_buffer <= self.image.shape[0]:
+                    if bbox[2] + zoom_buffer <= height:
                         bbox[2] += zoom_buffer
                     else:
                         bbox[0] -= (zoom_buffer -
-                                    ((self.image.shape[0] + zoom_buffer) - self.image.shape[0]))
-                        bbox[2] = self.image.shape[0]
+                                    ((height + zoom_buffer) - height))
+                        bbox[2] = height
 
                     if bbox[1] - zoom_buffer >= 0:
                         bbox[1] -= zoom_buffer
@@ -881,25 +1842,31 @@ class Sample:
                         bbox[3] += (zoom_buffer - bbox[1])
                         bbox[1] = 0
 
-                    if bbox[3] + zoom_buffer <= self.image.shape[1]:
+                    if bbox[3] + zoom_buffer <= width:
                         bbox[3] += zoom_buffer
                     else:
                         bbox[1] -= (zoom_buffer -
-                                    ((self.image.shape[1] + zoom_buffer) - self.image.shape[1]))
-                        bbox[3] = self.image.shape[1]
+                                    ((width + zoom_buffer) - width))
+                        bbox[3] = width
                     new_object = Object(n)
-                    new_object.set_preseg(np.where(label_img == region.label))
+                    new_object.set_preseg(preseg)
                     new_object.set_zoom(bbox)
-                    new_object.set_centroid(region.centroid)
+                    new_object.set_centroid(tuple(centroid))
                     self.objects.append(new_object)
         else:
             self.objects.append(Object(0))
 
     def load_image(self):
-        self.image = imread(self.path)
+        image = image_cache.get(self.path)
+        self.shape = image.shape
+        return image
 
 
 class Object:
+    # slots and float32 vertex arrays keep thousands of presegmented objects per image small
+    __slots__ = ('name', '_x', '_y', 'preseg', 'classtype', 'parent', 'centroid', 'zoom', 'owner')
+    fields = ('name', 'x', 'y', 'preseg', 'classtype', 'parent', 'centroid', 'zoom')
+
     def __init__(self, number, parent=None, suffix=None, zoom=None):
         if suffix is not None:
             self.name = 'Object ' + str(int(number))
@@ -917,6 +1884,36 @@ class Object:
         self.centroid = None
         self.zoom = zoom
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name != 'owner' and getattr(self, 'owner', None) is not None:
+            self.owner.touch()
+
+    def __getstate__(self):
+        return {name: getattr(self, name, None) for name in self.fields}
+
+    def __setstate__(self, state):
+        for name in self.fields:
+            object.__setattr__(self, name, state.get(name))
+        if self.classtype is None:
+            self.classtype = 0
+
+    @property
+    def x(self):
+        return self._x
+
+    @x.setter
+    def x(self, x):
+        object.__setattr__(self, '_x', vertices(x))
+
+    @property
+    def y(self):
+        return self._y
+
+    @y.setter
+    def y(self, y):
+        object.__setattr__(self, '_y', vertices(y))
+
     def set_zoom(self, bbox):
         self.zoom = [bbox[1], bbox[3], bbox[0], bbox[2]]
 
@@ -930,9 +1927,52 @@ class Object:
         self.parent = parent
 
     def set_preseg(self, preseg):
+        if isinstance(preseg, tuple):
+            preseg = Mask.from_indices(*preseg)
         self.preseg = preseg
 
 
+class Mask:
+    # bounding box local bitmask, 1 bit per pixel instead of two int64 indices
+    def __init__(self, origin, shape, bits):
+        self.origin = origin
+        self.shape = shape
+        self.bits = bits
+
+    @classmethod
+    def from_indices(cls, rows, cols):
+        rows = np.asarray(rows)
+        cols = np.asarray(cols)
+        origin = (int(rows.min()), int(cols.min()))
+        shape = (int(rows.max()) - origin[0] + 1, int(cols.max()) - origin[1] + 1)
+
+        local = np.zeros(shape, dtype=bool)
+        local[rows - origin[0], cols - origin[1]] = True
+
+        return cls(origin, shape, np.packbits(local))
+
+    @property
+    def bbox(self):
+        return (self.origin[0], self.origin[1], self.origin[0] + self.shape[0], self.origin[1] + self.shape[1])
+
+    def local(self):
+        count = self.shape[0] * self.shape[1]
+        return np.unpackbits(self.bits, count=count).reshape(self.shape).view(bool)
+
+    def indices(self):
+        rows, cols = np.nonzero(self.local())
+        return rows + self.origin[0], cols + self.origin[1]
+
+    def paint(self, image, value):
+        row, col = self.origin
+        image[row:row + self.shape[0], col:col + self.shape[1]][self.local()] = value
+
+    def raster(self, shape):
+        image = np.zeros(shape, dtype=bool)
+        self.paint(image, True)
+        return image
+
+
 class Backend(QObject):
     new_coords = pyqtSignal(list)
     ask_redraw = pyqtSignal(int)
@@ -1139,6 +2179,123 @@ class SaveTimer(QObject):
             self.savingtime.emit()
 
 
+class PoolWorker(QObject):
+    result = pyqtSignal(int, object)
+    failed = pyqtSignal(int)
+    progress = pyqtSignal(int)
+    finished = pyqtSignal(bool)
+
+    def __init__(self, function, jobs, workers=None):
+        super(QObject, self).__init__()
+        self.function = function
+        self.jobs = jobs
+        self.workers = workers or pool_workers or os.cpu_count()
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    @pyqtSlot()
+    def run(self):
+        done = 0
+        pending = {}
+        jobs = iter(enumerate(self.jobs))
+        context = multiprocessing.get_context(pool_start_method)
+        pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        unsent = []
+
+        try:
+            while not self.cancelled:
+                for n, args in jobs:
+                    unsent = [n]
+                    pending[pool.submit(self.function, *args)] = n
+                    unsent = []
+                    if len(pending) >= 2 * self.workers:
+                        break
+
+                if not pending:
+                    break
+
+                finished, _ = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    n = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception:
+                        self.failed.emit(n)
+                    else:
+                        self.result.emit(n, result)
+                    done += 1
+                    self.progress.emit(done)
+        except BrokenProcessPool:
+            # a worker process died, the pool takes no more jobs and everything left is reported as failed
+            for n in list(pending.values()) + unsent + [n for n, _ in jobs]:
+                self.failed.emit(n)
+                done += 1
+                self.progress.emit(done)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+            self.finished.emit(self.cancelled)
+
+
+class Prefetcher(QObject):
+    wake = pyqtSignal()
+
+    def __init__(self, next_n=prefetch_next, prev_n=prefetch_prev):
+        super(QObject, self).__init__()
+        self.next_n = next_n
+        self.prev_n = prev_n
+        self.hits = 0
+        self.misses = 0
+        self.queue = []
+        self.lock = threading.Lock()
+        self.wake.connect(self.run)
+
+    def set_depth(self, next_n, prev_n):
+        self.next_n = next_n
+        self.prev_n = prev_n
+
+    def neighbours(self, files, row):
+        samples = []
+        for distance in range(1, max(self.next_n, self.prev_n) + 1):
+            if distance <= self.next_n and row + distance < len(files):
+                samples.append(files[row + distance])
+            if distance <= self.prev_n and row - distance >= 0:
+                samples.append(files[row - distance])
+        return samples
+
+    def record(self, sample):
+        if sample.ready():
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def hit_rate(self):
+        if self.hits + self.misses == 0:
+            return 0.
+        return self.hits / (self.hits + self.misses)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate()}
+
+    def request(self, samples):
+        with self.lock:
+            self.queue = list(samples)
+        self.wake.emit()
+
+    @pyqtSlot()
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.queue:
+                    return
+                sample = self.queue.pop(0)
+            try:
+                sample.prepare()
+            except ValueError:
+                pass
+
+
 class MplCanvas(FigureCanvas):
     uparrow = pyqtSignal()
     downarrow = pyqtSignal()
@@ -1166,13 +2323,22 @@ class MplCanvas(FigureCanvas):
         self.centroid = None
         self.repeatdraw = False
         self.colormap = plt.cm.gist_rainbow(np.linspace(0, 1, init_class_n))
+        self.outline_colormap = ListedColormap([[0, 0, 0, 0], [1, 0, 0, 1]])
 
         self.linedict = {}
+        # outlines of all stored objects share one collection, segmentdict maps object -> segment
+        self.linecollection = None
+        self.segmentdict = {}
+        # drawn lines and the centroid live outside the axes and are blitted over the cached background
+        self.background = None
+        self.backgrounds = {}
+        self.image_artist = None
+        self.outline_artist = None
+        self.view_sample = None
 
         self.fig = Figure()
         self.axes = self.fig.add_subplot(111)
-        self.axes.invert_yaxis()
-        self.axes.axis('off')
+        self.clear()
 
         FigureCanvas.__init__(self, self.fig)
         self.setParent(parent)
@@ -1182,6 +2348,18 @@ class MplCanvas(FigureCanvas):
         FigureCanvas.setSizePolicy(self, QSizePolicy.Expanding, QSizePolicy.Expanding)
         FigureCanvas.updateGeometry(self)
 
+        self.lasso_active = False
+        self.mpl_connect('button_press_event', self.press)
+        self.mpl_connect('button_release_event', self.release)
+        self.mpl_connect('draw_event', self.on_draw)
+        self.mpl_connect('resize_event', self.update_view)
+
+    def press(self, event):
+        self.lasso_active = self.lasso is not None
+
+    def release(self, event):
+        self.lasso_active = False
+
     def onselect(self, verts):
         failure = False
         if self.currentObject.parent is None:
@@ -1220,34 +2398,96 @@ class MplCanvas(FigureCanvas):
         self.axes.clear()
         self.axes.invert_yaxis()
         self.axes.axis('off')
+        # limits are only set explicitly, every change picks the pyramid level and window to show
+        self.axes.set_autoscale_on(False)
+        self.axes.callbacks.connect('xlim_changed', self.update_view)
+        self.axes.callbacks.connect('ylim_changed', self.update_view)
+        self.linecollection = None
+        self.segmentdict = {}
+        self.image_artist = None
+        self.outline_artist = None
+        self.view_sample = None
+
+    def on_draw(self, event):
+        self.background = self.copy_from_bbox(self.axes.bbox)
+        # a full draw means the view changed, so only the background of the current outline state is valid
+        self.backgrounds = {self.outline_artist is not None and self.outline_artist.get_visible(): self.background}
+        self.draw_overlay()
+
+    def overlay(self, artist):
+        artist.set_figure(self.fig)
+        artist.axes = self.axes
+        artist.set_transform(self.axes.transData)
+        artist.set_clip_box(self.axes.bbox)
+        return artist
+
+    def draw_overlay(self):
+        for line in self.linedict.values():
+            self.axes.draw_artist(line)
+        if self.centroid is not None:
+            self.axes.draw_artist(self.centroid)
+
+    def blit_overlay(self):
+        if self.background is None:
+            self.draw()
+            return
+
+        self.restore_region(self.background)
+        self.draw_overlay()
+        self.blit(self.axes.bbox)
+        if self.lasso is not None:
+            # the canvas now holds background and overlay only, with the lasso line hidden the lasso copies it
+            # instead of redrawing the whole figure
+            visible = [artist.get_visible() for artist in self.lasso.artists]
+            for artist in self.lasso.artists:
+                artist.set_visible(False)
+            self.lasso.update_background(None)
+            for artist, state in zip(self.lasso.artists, visible):
+                artist.set_visible(state)
+
+    def reset_lasso(self):
+        if self.lasso is not None:
+            self.lasso.disconnect_events()
+            for artist in self.lasso.artists:
+                try:
+                    artist.remove()
+                except (ValueError, NotImplementedError):
+                    pass
+        self.lasso = None
 
     @pyqtSlot(list)
     def draw_object(self, coords):
-        if self.repeatdraw:
-            try:
-                self.linedict[self.currentObject].remove()
-            except:
-                pass
+        self.linedict.pop(self.currentObject, None)
+        outline = self.hide_outline(self.currentObject)
         self.currentObject.x = coords[0]
         self.currentObject.y = coords[1]
-        self.linedict[self.currentObject], = self.axes.plot(coords[0], coords[1], c=self.colormap[self.currentObject.classtype])
+        self.linedict[self.currentObject] = self.overlay(Line2D(coords[0], coords[1],
+                                                                color=self.colormap[self.currentObject.classtype]))
         self.repeatdraw = True
-        self.draw()
+        if outline:
+            self.draw()
+        else:
+            self.blit_overlay()
 
     def remove_object(self):
-        try:
-            self.linedict[self.currentObject].remove()
+        line = self.linedict.pop(self.currentObject, None)
+        if self.hide_outline(self.currentObject):
             self.draw()
-        except:
-            pass
+        elif line is not None:
+            self.blit_overlay()
 
         self.repeatdraw = False
         self.currentObject.x = None
         self.currentObject.y = None
 
     def draw_white(self):
+        if self.currentSample is not None:
+            self.currentSample.unpin()
+        self.reset_lasso()
+        self.linedict = {}
+        self.centroid = None
         self.clear()
-        img = self.axes.imshow(np.zeros((10, 10)), cmap='Greys', dtype=np.uint8)
+        self.image_artist = self.axes.imshow(np.zeros((10, 10), dtype=np.uint8), cmap='Greys')
         self.draw()
 
     def keyPressEvent(self, event):
@@ -1278,50 +2518,133 @@ class MplCanvas(FigureCanvas):
                 FigureCanvasBase.key_press_event(self, key, guiEvent=event)
 
     def plot(self, outlines_b):
-        self.axes.clear()
-        self.axes.invert_yaxis()
-        self.axes.axis('off')
-        self.axes.axis([0, self.currentImage.shape[1], 0, self.currentImage.shape[0]])
-
+        if self.linecollection is not None:
+            self.linecollection.remove()
+            self.linecollection = None
+            self.segmentdict = {}
+
+        height, width = self.currentImage.shape[:2]
+        extent = (-0.5, width - 0.5, height - 0.5, -0.5)
+        if in_memory(self.currentImage):
+            image = self.currentImage
+        else:
+            # contrast of images that are not in memory is taken from the overview level
+            image = self.currentSample.display_level(self.view_level(width, height))
         try:
-            img = self.axes.imshow(self.currentImage, cmap='Greys')
+            if self.image_artist is None:
+                self.image_artist = self.axes.imshow(image, cmap='Greys')
+            else:
+                self.image_artist.set_data(image)
+                self.image_artist.autoscale()
+                self.image_artist.set_extent(extent)
         except:
             self.delete_image.emit()
+            return False
+
+        outlines = self.currentSample.outlines
+        if outlines is not None:
+            # outlines stay packed, update_view unpacks the visible window
+            if self.outline_artist is None:
+                self.outline_artist = self.axes.imshow(outlines[:1, :1], cmap=self.outline_colormap, vmin=0, vmax=1,
+                                                       interpolation='nearest')
+            else:
+                self.outline_artist.set_data(outlines[:1, :1])
+                self.outline_artist.set_extent(extent)
+        if self.outline_artist is not None:
+            self.outline_artist.set_visible(outlines is not None and outlines_b is True)
+
+        self.view_sample = self.currentSample
+        self.axes.axis([0, self.currentImage.shape[1], 0, self.currentImage.shape[0]])
+        self.update_view()
+
+        return True
+
+    def view_level(self, xspan, yspan):
+        height, width = self.currentImage.shape[:2]
+        scale = min(xspan / max(self.axes.bbox.width, 1), yspan / max(self.axes.bbox.height, 1))
+        return int(min(np.floor(np.log2(max(scale, 1))), np.log2(min(height, width))))
+
+    def update_view(self, *args):
+        if self.view_sample is None or self.image_artist is None:
+            return
+
+        height, width = self.currentImage.shape[:2]
+        xmin, xmax = sorted(self.axes.get_xlim())
+        ymin, ymax = sorted(self.axes.get_ylim())
+        level = self.view_level(xmax - xmin, ymax - ymin)
+        factor = 2 ** level
+
+        row_start, row_stop = view_window(ymin, ymax, height, factor)
+        col_start, col_stop = view_window(xmin, xmax, width, factor)
+        extent = (col_start * factor - 0.5, col_stop * factor - 0.5, row_stop * factor - 0.5, row_start * factor - 0.5)
+
+        artists = [(self.image_artist, False)]
+        if self.outline_artist is not None and self.view_sample.outlines is not None:
+            artists.append((self.outline_artist, True))
+        for artist, outlines in artists:
+            image = self.view_sample.display_level(level, outlines)
+            artist.set_data(image[row_start:row_stop, col_start:col_stop])
+            artist.set_extent(extent)
+
+    def set_outlines(self, outlines_b):
+        if self.outline_artist is None or self.currentSample.outlines is None:
             return
 
-        if self.currentSample.outlines is not None and outlines_b is True:
-            self.axes.imshow(self.currentSample.outlines, cmap='Greys', interpolation='nearest')
+        visible = outlines_b is True
+        self.outline_artist.set_visible(visible)
+        if visible in self.backgrounds:
+            self.background = self.backgrounds[visible]
+            self.blit_overlay()
+        else:
+            # the background of the other state is still valid, keep it for toggling back
+            backgrounds = self.backgrounds
+            self.draw()
+            self.backgrounds.update({state: background for state, background in backgrounds.items() if state != visible})
 
-        self.draw()
+    def plot_outlines(self):
+        objects = [obj for obj in self.currentSample.objects if obj.x is not None]
+        self.segmentdict = {obj: n for n, obj in enumerate(objects)}
+        self.linecollection = LineCollection([np.column_stack([obj.x, obj.y]) for obj in objects],
+                                             colors=[self.colormap[obj.classtype] for obj in objects])
+        self.axes.add_collection(self.linecollection, autolim=False)
+
+    def hide_outline(self, obj):
+        if obj not in self.segmentdict:
+            return False
+        segments = self.linecollection.get_segments()
+        segments[self.segmentdict.pop(obj)] = np.zeros((0, 2))
+        self.linecollection.set_segments(segments)
+        return True
 
     def remove_centroid(self):
-        try:
-            self.centroid.remove()
-        except:
-            pass
+        self.centroid = None
 
     def set_colormap(self, class_n):
         self.colormap = plt.cm.rainbow(np.linspace(0, 1, class_n))
 
     def set_image(self, currentFile, outlines_b):
+        currentFile.prepare()
+
+        if self.currentSample is not None and self.currentSample.path != currentFile.path:
+            self.currentSample.unpin()
+        currentFile.pin()
+
         self.currentSample = currentFile
         self.currentImage = self.currentSample.image
-        self.lasso = None
+        self.reset_lasso()
 
         self.remove_centroid()
+        self.linedict = {}
 
-        self.plot(outlines_b=outlines_b)
-
-        for obj in range(len(self.currentSample.objects)):
-            if self.currentSample.objects[obj].x is not None:
-                self.axes.plot(self.currentSample.objects[obj].x, self.currentSample.objects[obj].y,
-                               c=self.colormap[self.currentSample.objects[obj].classtype])
-                self.draw()
+        if self.plot(outlines_b=outlines_b):
+            self.plot_outlines()
+        self.draw()
 
     def set_object(self, currentObject):
         self.currentObject = currentObject
         self.repeatdraw = False
-        self.lasso = LassoSelector(self.axes, self.onselect)
+        self.reset_lasso()
+        self.lasso = LassoSelector(self.axes, self.onselect, useblit=True)
 
         if self.currentObject is not None:
             if self.currentObject.x is not None:
@@ -1329,13 +2652,22 @@ class MplCanvas(FigureCanvas):
             else:
                 self.repeatdraw = False
 
+            # the selected outline moves from the collection to the overlay, so redrawing or recolouring it is a blit
+            moved = self.hide_outline(self.currentObject)
+            if moved:
+                self.linedict[self.currentObject] = self.overlay(Line2D(
+                    self.currentObject.x, self.currentObject.y, color=self.colormap[self.currentObject.classtype]))
+
             if self.currentObject.zoom is not None:
                 self.zoom()
+            elif moved:
+                self.draw()
 
     def set_class(self):
-        if self.currentObject.x is not None:
-            self.axes.plot(self.currentObject.x, self.currentObject.y, c=self.colormap[self.currentObject.classtype])
-            self.draw()
+        # set_object moved the outline of the current object into the overlay
+        if self.currentObject.x is not None and self.currentObject in self.linedict:
+            self.linedict[self.currentObject].set_color(self.colormap[self.currentObject.classtype])
+            self.blit_overlay()
 
     def dezoom(self):
         self.remove_centroid()
@@ -1348,7 +2680,8 @@ class MplCanvas(FigureCanvas):
             self.axes.axis([self.currentObject.zoom[0], self.currentObject.zoom[1],
                             self.currentObject.zoom[2], self.currentObject.zoom[3]])
             if self.currentObject.centroid is not None:
-                self.centroid = self.axes.scatter(self.currentObject.centroid[1], self.currentObject.centroid[0], s=50, c='b')
+                self.centroid = self.overlay(Line2D([self.currentObject.centroid[1]], [self.currentObject.centroid[0]],
+                                                    linestyle='', marker='o', markersize=7, color='b'))
             self.draw()
 
 
@@ -1368,7 +2701,8 @@ class FileDialog(QWidget):
         options = QFileDialog.Options()
         options |= QFileDialog.DontUseNativeDialog
         fileName, _ = QFileDialog.getOpenFileName(self, "QFileDialog.getOpenFileName()", "",
-                                                  "Pickle Files (*.pickle)", options=options)
+                                                  "Project Files (manifest.json);;Pickle Files (*.pickle)",
+                                                  options=options)
 
         return fileName
 
@@ -1383,16 +2717,20 @@ class FileDialog(QWidget):
         options = QFileDialog.Options()
         options |= QFileDialog.DontUseNativeDialog
         file, _ = QFileDialog.getSaveFileName(self, "Select saving path.", "",
-                                                  "Pickle Files (*.pickle)", options=options)
+                                                  "Project Folders (*.elk)", options=options)
 
         return file
 
 
 class TreeItem:
-    def __init__(self, data, parent=None):
+    def __init__(self, data, parent=None, source=None):
         self.parentItem = parent
         self.itemData = data
         self.childItems = []
+        self.rowNumber = 0
+        # items with a source sample get their object children on first fetch
+        self.source = source
+        self.fetched = source is None
 
     def child(self, row):
         return self.childItems[row]
@@ -1401,9 +2739,16 @@ class TreeItem:
         return len(self.childItems)
 
     def childNumber(self):
-        if self.parentItem != None:
-            return self.parentItem.childItems.index(self)
-        return 0
+        return self.rowNumber
+
+    def hasChildren(self):
+        if not self.fetched:
+            return self.source.object_count() > 0
+        return len(self.childItems) > 0
+
+    def renumber(self, position):
+        for row in range(position, len(self.childItems)):
+            self.childItems[row].rowNumber = row
 
     def columnCount(self):
         return len(self.itemData)
@@ -1415,13 +2760,19 @@ class TreeItem:
         if position < 0 or position > len(self.childItems):
             return False
 
-        for row in range(count):
-            data = [None for v in range(columns)]
-            item = TreeItem(data, self)
-            self.childItems.insert(position, item)
+        self.childItems[position:position] = [TreeItem([None for v in range(columns)], self) for row in range(count)]
+        self.renumber(position)
 
         return True
 
+    def appendChildren(self, values, columns, sources=None):
+        if sources is None:
+            sources = [None] * len(values)
+        position = len(self.childItems)
+        self.childItems.extend(TreeItem([value] + [None for v in range(columns - 1)], self, source)
+                               for value, source in zip(values, sources))
+        self.renumber(position)
+
     def insertColumns(self, position, columns):
         if position < 0 or position > len(self.itemData):
             return False
@@ -1441,8 +2792,8 @@ class TreeItem:
         if position < 0 or position + count > len(self.childItems):
             return False
 
-        for row in range(count):
-            self.childItems.pop(position)
+        del self.childItems[position:position + count]
+        self.renumber(position)
 
         return True
 
@@ -1494,63 +2845,75 @@ class ItemModel(QAbstractItemModel):
         self.modeltype = modeltype
         self.setupModelData(data, modeltype, self.rootItem)
 
+    def add_image(self, sample):
+        if self.modeltype == 'tree':
+            row = self.rootItem.childCount()
+            self.beginInsertRows(QModelIndex(), row, row)
+            self.rootItem.appendChildren([sample.name], self.rootItem.columnCount(), [sample])
+            self.endInsertRows()
+
+    def fetch_image(self, row):
+        item = self.rootItem.child(row)
+        if not item.fetched:
+            self.fetchMore(self.index(row, 0, QModelIndex()))
+        return item
+
     def remove_image(self, index):
         if self.modeltype == 'tree':
-            indexObject = self.index(index.row(), 0, 'rootparent')
-            self.beginRemoveRows(indexObject, index.row(), index.row())
+            self.beginRemoveRows(QModelIndex(), index.row(), index.row())
             self.rootItem.removeChildren(index.row(), 1)
             self.endRemoveRows()
-            self.layoutChanged.emit()
 
     def add_object(self, parent, index):
         if self.modeltype == 'tree':
+            item = self.fetch_image(parent.row())
             if index is None:
-                self.rootItem.child(parent.row()).insertChildren(self.rootItem.child(parent.row()).childCount(),
-                                                                 1, self.rootItem.columnCount())
-                if self.rootItem.child(parent.row()).childCount() > 1:
-                    self.rootItem.child(parent.row()).child(self.rootItem.child(parent.row()).childCount() - 1).\
-                        setData(0, 'Object ' + self.get_subname(parent, index))
-                else:
-                    self.rootItem.child(parent.row()).child(self.rootItem.child(parent.row()).childCount() - 1). \
-                        setData(0, 'Object 1')
+                row = item.childCount()
+                name = 'Object ' + self.get_subname(parent, index) if row > 0 else 'Object 1'
             else:
                 name, offset = self.get_subname(parent, index)
-                self.rootItem.child(parent.row()).insertChildren(index.row() + 1 + offset, 1, self.rootItem.columnCount())
-                self.rootItem.child(parent.row()).child(index.row() + 1 + offset).setData(0, name)
+                row = index.row() + 1 + offset
 
-            self.layoutChanged.emit()
+            self.beginInsertRows(parent, row, row)
+            item.insertChildren(row, 1, self.rootItem.columnCount())
+            item.child(row).setData(0, name)
+            self.endInsertRows()
 
     def remove_object(self, parent, index):
         if self.modeltype == 'tree':
+            item = self.fetch_image(parent.row())
             self.beginRemoveRows(parent, index.row(), index.row())
-            self.rootItem.child(parent.row()).removeChildren(index.row(), 1)
+            item.removeChildren(index.row(), 1)
             self.endRemoveRows()
-            self.layoutChanged.emit()
 
     def remove_all_objects(self, parent):
         if self.modeltype == 'tree':
-            self.beginRemoveRows(parent, 0, self.rootItem.child(parent.row()).childCount())
-            self.rootItem.child(parent.row()).removeChildren(0, self.rootItem.child(parent.row()).childCount())
+            item = self.fetch_image(parent.row())
+            count = item.childCount()
+            if count == 0:
+                return
+            self.beginRemoveRows(parent, 0, count - 1)
+            item.removeChildren(0, count)
             self.endRemoveRows()
-            self.layoutChanged.emit()
 
     def add_class(self):
         if self.modeltype == 'list':
-            self.rootItem.insertChildren(self.rootItem.childCount(), 1, self.rootItem.columnCount())
-            self.rootItem.child(self.rootItem.childCount() - 1).setData(0, 'Class ' + str(self.rootItem.childCount()))
-            self.layoutChanged.emit()
+            row = self.rootItem.childCount()
+            self.beginInsertRows(QModelIndex(), row, row)
+            self.rootItem.appendChildren(['Class ' + str(row + 1)], self.rootItem.columnCount())
+            self.endInsertRows()
 
     def remove_class(self):
         if self.modeltype == 'list':
-            indexObject = self.index(-1, 0, 'rootparent')
-            self.beginRemoveRows(indexObject.parent(), -1, -1)
-            self.rootItem.removeChildren(self.rootItem.childCount() - 1, 1)
-            self.endInsertRows()
-            self.layoutChanged.emit()
+            row = self.rootItem.childCount() - 1
+            self.beginRemoveRows(QModelIndex(), row, row)
+            self.rootItem.removeChildren(row, 1)
+            self.endRemoveRows()
 
     def get_subname(self, parent, index):
         if index is None:
-            name = self.rootItem.child(parent.row()).child(self.rootItem.child(parent.row()).childCount() - 2).data(0)
+            item = self.fetch_image(parent.row())
+            name = item.child(item.childCount() - 1).data(0)
             name = name.split(' ')[-1]
             try:
                 name, suffix = name.split('.')
@@ -1560,11 +2923,12 @@ class ItemModel(QAbstractItemModel):
 
             return name
         else:
-            name = self.rootItem.child(parent.row()).child(index.row()).data(0)
+            item = self.fetch_image(parent.row())
+            name = item.child(index.row()).data(0)
             n = 0
             while True:
                 try:
-                    nextname = self.rootItem.child(parent.row()).child(index.row() + n+1).data(0)
+                    nextname = item.child(index.row() + n+1).data(0)
                 except IndexError:
                     if '.' in name:
                         number, suffix = name.split('.')
@@ -1587,6 +2951,9 @@ class ItemModel(QAbstractItemModel):
 
             return name, n
 
+    def canFetchMore(self, parent):
+        return not self.getItem(parent).fetched
+
     def columnCount(self, parent=QModelIndex()):
         return self.rootItem.columnCount()
 
@@ -1603,9 +2970,21 @@ class ItemModel(QAbstractItemModel):
         except:
             return None
 
+    def fetchMore(self, parent):
+        item = self.getItem(parent)
+        if item.fetched:
+            return
+
+        names = [obj.name for obj in item.source.objects]
+        item.fetched = True
+        if names:
+            self.beginInsertRows(parent, 0, len(names) - 1)
+            item.appendChildren(names, self.rootItem.columnCount())
+            self.endInsertRows()
+
     def flags(self, index):
         if not index.isValid():
-            return 0
+            return Qt.NoItemFlags
 
         return Qt.ItemIsEditable | super(ItemModel, self).flags(index)
 
@@ -1617,6 +2996,9 @@ class ItemModel(QAbstractItemModel):
 
         return self.rootItem
 
+    def hasChildren(self, parent=QModelIndex()):
+        return self.getItem(parent).hasChildren()
+
     def headerData(self, section, orientation, role=Qt.DisplayRole):
         if orientation == Qt.Horizontal and role == Qt.DisplayRole:
             return self.rootItem.data(section)
@@ -1719,24 +3101,715 @@ class ItemModel(QAbstractItemModel):
         return result
 
     def setupModelData(self, data, modeltype, parent):
+        columns = self.rootItem.columnCount()
         if modeltype == 'list':
-            for n in range(data):
-                parent.insertChildren(parent.childCount(), 1, self.rootItem.columnCount())
-                parent.child(parent.childCount() - 1).setData(0, 'Class ' + str(n + 1))
+            parent.appendChildren(['Class ' + str(n + 1) for n in range(data)], columns)
         elif modeltype == 'tree':
-            parents = [parent]
-            for m, key in enumerate(data.files):
-                parents[0].insertChildren(parents[0].childCount(), 1, self.rootItem.columnCount())
-                parents[0].child(parents[0].childCount() - 1).setData(0, key.name)
+            parent.appendChildren([key.name for key in data.files], columns, data.files)
 
-                parents.append(parents[0].child(parents[0].childCount() - 1))
 
-                for n, obj in enumerate(key.objects):
-                    parents[-1].insertChildren(parents[-1].childCount(), 1, self.rootItem.columnCount())
-                    parents[-1].child(parents[-1].childCount() - 1).setData(0, obj.name)
+###################################################### Functions
 
 
-###################################################### Functions
+def write_atomic(filename, content):
+    tmpname = filename + '.' + str(os.getpid()) + '.tmp'
+    with open(tmpname, 'wb') as file:
+        file.write(content)
+    os.replace(tmpname, filename)
+
+
+def freeze_objects(objects):
+    # cheap copy of everything a shard needs, vertex arrays and masks are never changed in place and are shared
+    numbers = {id(obj): n for n, obj in enumerate(objects)}
+    frozen = []
+    for obj in objects:
+        frozen.append({'name': obj.name,
+                       'classtype': obj.classtype,
+                       'parent': numbers.get(id(obj.parent)) if obj.parent is not None else None,
+                       'x': obj.x,
+                       'y': obj.y,
+                       'centroid': obj.centroid,
+                       'zoom': list(obj.zoom) if obj.zoom is not None else None,
+                       'preseg': obj.preseg})
+    return frozen
+
+
+def dump_objects(frozen):
+    entries = []
+    masks = []
+    lines = []
+    for n, obj in enumerate(frozen):
+        entries.append({'name': obj['name'],
+                        'classtype': int(obj['classtype']),
+                        'parent': obj['parent'],
+                        'centroid': [float(v) for v in obj['centroid']] if obj['centroid'] is not None else None,
+                        'zoom': [float(v) for v in obj['zoom']] if obj['zoom'] is not None else None})
+        if obj['preseg'] is not None:
+            masks.append((n, obj['preseg']))
+        if obj['x'] is not None:
+            lines.append((n, np.stack([obj['x'], obj['y']], axis=1)))
+
+    # all polygon vertices of a sample go into one float32 buffer, sliced per object by vertex_offsets
+    arrays = {'vertex_index': np.array([n for n, _ in lines], dtype=np.int64),
+              'vertex_offsets': np.cumsum([0] + [len(line) for _, line in lines]).astype(np.int64),
+              'vertices': np.concatenate([line for _, line in lines] + [np.zeros((0, 2), dtype=np.float32)]),
+              'index': np.array([n for n, _ in masks], dtype=np.int64),
+              'origins': np.array([mask.origin for _, mask in masks], dtype=np.int64).reshape(-1, 2),
+              'shapes': np.array([mask.shape for _, mask in masks], dtype=np.int64).reshape(-1, 2),
+              'offsets': np.cumsum([0] + [len(mask.bits) for _, mask in masks]).astype(np.int64),
+              'bits': np.concatenate([mask.bits for _, mask in masks] + [np.zeros(0, dtype=np.uint8)])}
+
+    content = json.dumps({'objects': entries}).encode()
+
+    digest = hashlib.sha1(content)
+    for key in sorted(arrays):
+        digest.update(arrays[key].tobytes())
+
+    return content, arrays, digest.hexdigest()
+
+
+def load_objects(shard):
+    with open(shard + '.json', 'r') as file:
+        entries = json.load(file)['objects']
+
+    objects = []
+    for entry in entries:
+        obj = Object(0)
+        obj.name = entry['name']
+        obj.classtype = entry['classtype']
+        obj.x = entry.get('x')
+        obj.y = entry.get('y')
+        obj.centroid = tuple(entry['centroid']) if entry['centroid'] is not None else None
+        obj.zoom = entry['zoom']
+        objects.append(obj)
+
+    for obj, entry in zip(objects, entries):
+        if entry['parent'] is not None:
+            obj.parent = objects[entry['parent']]
+
+    with np.load(shard + '.npz', allow_pickle=False) as arrays:
+        offsets = arrays['offsets']
+        bits = arrays['bits']
+        for m, n in enumerate(arrays['index']):
+            origin = tuple(int(v) for v in arrays['origins'][m])
+            shape = tuple(int(v) for v in arrays['shapes'][m])
+            objects[n].preseg = Mask(origin, shape, bits[offsets[m]:offsets[m + 1]].copy())
+
+        if 'vertices' in arrays:
+            offsets = arrays['vertex_offsets']
+            points = arrays['vertices']
+            for m, n in enumerate(arrays['vertex_index']):
+                objects[n].x = points[offsets[m]:offsets[m + 1], 0]
+                objects[n].y = points[offsets[m]:offsets[m + 1], 1]
+
+    return objects
+
+
+def vertices(values):
+    if values is None:
+        return None
+    return np.array(values, dtype=np.float32)
+
+
+def open_image(path):
+    # small images are decoded whole, large TIFFs are memory mapped if uncompressed or read tile by tile
+    if tifffile is not None and path.lower().endswith(('.tif', '.tiff')):
+        try:
+            with tifffile.TiffFile(path) as tif:
+                series = tif.series[0]
+                page = tif.pages[0]
+                large = series.size * series.dtype.itemsize > tile_threshold and len(series.pages) == 1
+                mappable = page.is_memmappable
+                tiled = page.imagedepth == 1 and (page.planarconfig == 1 or page.samplesperpixel == 1)
+        except Exception:
+            large = False
+
+        if large and mappable:
+            return tifffile.memmap(path, mode='r')
+        if large and tiled:
+            return TiledImage(path)
+
+    return imread(path)
+
+
+def in_memory(image):
+    return isinstance(image, np.ndarray) and not isinstance(image, np.memmap)
+
+
+def resident_bytes(image):
+    return image.nbytes if in_memory(image) else 0
+
+
+def downsample(image, factor=2):
+    # block mean, block any for masks so thin outlines survive, sources are read in row bands
+    height, width = image.shape[:2]
+    itemsize = np.dtype(image.dtype).itemsize * int(np.prod(image.shape[2:]))
+    band = factor * max(1, downsample_band // max(1, width * factor * itemsize))
+
+    levels = []
+    for start in range(0, height, band):
+        block = np.asarray(image[start:start + band])
+        if block.shape[0] % factor or block.shape[1] % factor:
+            pad = [(0, -block.shape[0] % factor), (0, -block.shape[1] % factor)] + [(0, 0)] * (block.ndim - 2)
+            block = np.pad(block, pad, mode='edge')
+
+        block = block.reshape((block.shape[0] // factor, factor, block.shape[1] // factor, factor) + block.shape[2:])
+        if block.dtype == bool:
+            levels.append(block.any(axis=(1, 3)))
+        else:
+            levels.append(block.mean(axis=(1, 3), dtype=np.float32).astype(image.dtype))
+
+    return np.concatenate(levels)
+
+
+def view_window(low, high, size, factor):
+    # index range of a pyramid level that covers [low, high] in full resolution pixels, with one pixel margin
+    start = min(max(int(np.floor(low + 0.5)) - 1, 0), size - 1) // factor
+    stop = -(-min(max(int(np.ceil(high + 0.5)) + 1, 1), size) // factor)
+    return start, max(stop, start + 1)
+
+
+def read_label(path):
+    if path.endswith('.npy'):
+        return np.load(path)
+    else:
+        return imread(path)
+
+
+def segment(image, presegmentation=None):
+    if image.ndim == 2 and (not in_memory(image) or image.nbytes > preseg_tiled):
+        return segment_tiled(image, presegmentation)
+
+    image = np.asarray(image)
+    if presegmentation is None:
+        thresh = threshold_otsu(image)
+        binary = image > thresh
+    else:
+        binary = presegmentation
+        binary[binary > 1] = 1
+
+    if binary.shape[0] != image.shape[0] or binary.shape[1] != image.shape[1]:
+        raise ValueError
+
+    binary = binary_closing(binary)
+    binary_filled = binary_fill_holes(binary)
+    cleared = clear_border(binary_filled)
+    label_img = label(cleared)
+    label_img = remove_small_objects(label_img, min_size=otsu_min_size)
+
+    pre_outlines = label_img > 0
+    outlines = pre_outlines & ~binary_erosion(pre_outlines)
+
+    regions = extract_regions(label_img)
+    values = [label_img[rows[0], cols[0]] for (rows, cols), _, _ in regions]
+    masks = [np.packbits(label_img[bbox[0]:bbox[2], bbox[1]:bbox[3]] == value)
+             for value, (_, bbox, _) in zip(values, regions)]
+
+    return segmentation_arrays(image.shape, np.packbits(outlines, axis=1), [bbox for _, bbox, _ in regions],
+                               [centroid for _, _, centroid in regions], masks)
+
+
+def segment_tiled(image, presegmentation=None):
+    # same pipeline as segment on overlapping tiles, components are joined across the seams afterwards
+    height, width = image.shape
+    if presegmentation is not None and presegmentation.shape[:2] != (height, width):
+        raise ValueError
+
+    size = max(preseg_tile // 8 * 8, 8)  # keeps tile columns byte aligned in the packed bitmaps
+    tiles = [(i, j, r0, min(r0 + size, height), c0, min(c0 + size, width))
+             for i, r0 in enumerate(range(0, height, size)) for j, c0 in enumerate(range(0, width, size))]
+
+    if presegmentation is None:
+        thresh = tiled_threshold(image, tiles)
+
+    # closing reaches two pixels into the neighbours, every later step only needs the closed bitmap
+    closed = np.zeros((height, (width + 7) // 8), dtype=np.uint8)
+    for _, _, r0, r1, c0, c1 in tiles:
+        a, b, c, d = max(r0 - 2, 0), min(r1 + 2, height), max(c0 - 2, 0), min(c1 + 2, width)
+        if presegmentation is None:
+            binary = np.asarray(image[a:b, c:d]) > thresh
+        else:
+            binary = presegmentation[a:b, c:d] != 0
+        closed[r0:r1, c0 // 8:(c1 + 7) // 8] = np.packbits(binary_closing(binary)[r0 - a:r1 - a, c0 - c:c1 - c], axis=1)
+
+    # background is 4-connected as in binary_fill_holes, holes are the parts that never reach the image border
+    hole_offsets, edges, border = {}, {}, [np.zeros(1, dtype=np.int64)]
+    total = 0
+    for i, j, r0, r1, c0, c1 in tiles:
+        background, n = ndimage.label(~unpack_window(closed, r0, r1, c0, c1), output=np.int64)
+        background[background > 0] += total
+        hole_offsets[i, j] = total
+        edges[i, j] = tile_edges(background)
+        border.append(tile_border(background, r0 == 0, r1 == height, c0 == 0, c1 == width))
+        total += n
+
+    roots = stitch_labels(edges, total, diagonal=False)
+    outside = np.zeros(roots.max() + 1, dtype=bool)
+    outside[roots[np.concatenate(border)]] = True
+    holes = ~outside[roots]
+    holes[0] = False
+
+    def filled_labels(i, j, r0, r1, c0, c1):
+        core = unpack_window(closed, r0, r1, c0, c1)
+        background = ndimage.label(~core, output=np.int64)[0]
+        background[background > 0] += hole_offsets[i, j]
+        return ndimage.label(core | holes[background], structure=np.ones((3, 3)), output=np.int64)
+
+    # objects are 8-connected as in label and clear_border
+    offsets, edges, border, stats = {}, {}, [np.zeros(1, dtype=np.int64)], [np.zeros((1, 8), dtype=np.int64)]
+    total = 0
+    for tile in tiles:
+        i, j, r0, r1, c0, c1 = tile
+        objects, n = filled_labels(*tile)
+        stats.append(tile_stats(objects, n, r0, c0, width))
+        objects[objects > 0] += total
+        offsets[i, j] = total
+        edges[i, j] = tile_edges(objects)
+        border.append(tile_border(objects, r0 == 0, r1 == height, c0 == 0, c1 == width))
+        total += n
+
+    roots = stitch_labels(edges, total, diagonal=True)
+    stats = np.concatenate(stats)
+    count = roots.max() + 1
+    merged = np.zeros((count, 8), dtype=np.int64)
+    merged[:, 1:4] = height * width
+    np.add.at(merged[:, 0], roots, stats[:, 0])
+    np.minimum.at(merged[:, 1], roots, stats[:, 1])
+    np.minimum.at(merged[:, 2], roots, stats[:, 2])
+    np.minimum.at(merged[:, 3], roots, stats[:, 3])
+    np.maximum.at(merged[:, 4], roots, stats[:, 4])
+    np.maximum.at(merged[:, 5], roots, stats[:, 5])
+    np.add.at(merged[:, 6], roots, stats[:, 6])
+    np.add.at(merged[:, 7], roots, stats[:, 7])
+
+    cleared = np.zeros(count, dtype=bool)
+    cleared[roots[np.concatenate(border)]] = True
+    cleared[roots[0]] = True
+
+    # ordered by first pixel like label, small objects are dropped afterwards
+    kept = np.flatnonzero(~cleared)
+    kept = kept[np.argsort(merged[kept, 1], kind='stable')]
+    large = merged[kept, 0] > otsu_min_size  # remove_small_objects maps min_size onto the inclusive max_size
+    kept = kept[large]
+    merged = merged[kept]
+    bboxes = merged[:, 2:6]
+
+    index = np.zeros(count, dtype=np.int64)
+    index[kept] = np.arange(1, len(kept) + 1)
+    index = index[roots]
+
+    # object masks are filled tile by tile and packed as soon as all their pixels arrived
+    pre = np.zeros_like(closed)
+    masks, bits, remaining = {}, {}, merged[:, 0].copy()
+    for tile in tiles:
+        i, j, r0, r1, c0, c1 = tile
+        objects = filled_labels(*tile)[0]
+        objects[objects > 0] += offsets[i, j]
+        objects = index[objects]
+        pre[r0:r1, c0 // 8:(c1 + 7) // 8] = np.packbits(objects > 0, axis=1)
+        for (rows, cols), _, _ in extract_regions(objects):
+            n = objects[rows[0], cols[0]] - 1
+            top, left, bottom, right = bboxes[n]
+            if n not in masks:
+                masks[n] = np.zeros((bottom - top, right - left), dtype=bool)
+            masks[n][rows + (r0 - top), cols + (c0 - left)] = True
+            remaining[n] -= len(rows)
+            if remaining[n] == 0:
+                bits[n] = np.packbits(masks.pop(n))
+
+    outlines = np.zeros_like(closed)
+    for _, _, r0, r1, c0, c1 in tiles:
+        a, b, c, d = max(r0 - 1, 0), min(r1 + 1, height), max(c0 - 1, 0), min(c1 + 1, width)
+        window = unpack_window(pre, a, b, c, d)
+        edge = window & ~binary_erosion(window)
+        outlines[r0:r1, c0 // 8:(c1 + 7) // 8] = np.packbits(edge[r0 - a:r1 - a, c0 - c:c1 - c], axis=1)
+
+    centroids = merged[:, 6:8] / merged[:, :1]
+    return segmentation_arrays(image.shape, outlines, bboxes, centroids, [bits[n] for n in range(len(kept))])
+
+
+def tiled_threshold(image, tiles):
+    # threshold_otsu from a histogram gathered tile by tile, binned like skimage bins the whole image
+    low = high = None
+    for _, _, r0, r1, c0, c1 in tiles:
+        part = np.asarray(image[r0:r1, c0:c1])
+        low = part.min() if low is None else min(low, part.min())
+        high = part.max() if high is None else max(high, part.max())
+    if low == high:
+        return low
+
+    if np.issubdtype(image.dtype, np.integer):
+        low, high = int(low), int(high)
+        counts = np.zeros(high - low + 1, dtype=np.int64)
+        for _, _, r0, r1, c0, c1 in tiles:
+            part = np.asarray(image[r0:r1, c0:c1]).astype(np.int64) - low
+            counts += np.bincount(part.ravel(), minlength=len(counts))
+        centers = np.arange(low, high + 1)
+    else:
+        counts = np.zeros(256, dtype=np.int64)
+        for _, _, r0, r1, c0, c1 in tiles:
+            part, edges = np.histogram(np.asarray(image[r0:r1, c0:c1]), bins=256, range=(low, high))
+            counts += part
+        centers = (edges[:-1] + edges[1:]) / 2.0
+
+    return threshold_otsu(hist=(counts, centers))
+
+
+def sliced_region(image, key):
+    # basic indexing for TiledImage and PackedMask, only the bounding window of the key is read through region
+    if not isinstance(key, tuple):
+        key = (key,)
+    key = key + (slice(None),) * (2 - len(key))
+
+    bounds = []
+    steps = []
+    for index, size in zip(key[:2], image.shape[:2]):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(size)
+            if step < 0:
+                raise IndexError('negative steps are not supported')
+            steps.append(slice(None, None, step))
+        else:
+            start = int(index) % size
+            stop = start + 1
+            steps.append(0)
+        bounds.append((start, max(stop, start)))
+
+    region = image.region(bounds[0][0], bounds[0][1], bounds[1][0], bounds[1][1])
+    return region[tuple(steps) + key[2:]]
+
+
+def unpack_window(bitmap, r0, r1, c0, c1):
+    start = c0 // 8
+    bits = np.unpackbits(bitmap[r0:r1, start:(c1 + 7) // 8], axis=1)
+    return bits[:, c0 - 8 * start:c1 - 8 * start].view(bool)
+
+
+def tile_edges(labels):
+    return labels[0].copy(), labels[-1].copy(), labels[:, 0].copy(), labels[:, -1].copy()
+
+
+def tile_border(labels, top, bottom, left, right):
+    sides = [side for side, touches in zip(tile_edges(labels), (top, bottom, left, right)) if touches]
+    sides = np.unique(np.concatenate([np.zeros(0, dtype=labels.dtype)] + sides))
+    return sides[sides > 0]
+
+
+def tile_stats(labels, n, row, col, width):
+    # area, first pixel, bbox and coordinate sums per label in image coordinates
+    stats = np.zeros((n, 8), dtype=np.int64)
+    flat = labels.ravel()
+    pixels = np.flatnonzero(flat)
+    if n == 0:
+        return stats
+
+    ids = flat[pixels]
+    order = np.argsort(ids, kind='stable')
+    pixels = pixels[order]
+    starts = np.flatnonzero(np.r_[True, ids[order][1:] != ids[order][:-1]])
+    rows, cols = np.divmod(pixels, labels.shape[1])
+    rows += row
+    cols += col
+
+    stats[:, 0] = np.diff(np.r_[starts, len(pixels)])
+    stats[:, 1] = rows[starts] * width + cols[starts]
+    stats[:, 2] = rows[starts]
+    stats[:, 3] = np.minimum.reduceat(cols, starts)
+    stats[:, 4] = np.maximum.reduceat(rows, starts) + 1
+    stats[:, 5] = np.maximum.reduceat(cols, starts) + 1
+    stats[:, 6] = np.add.reduceat(rows, starts)
+    stats[:, 7] = np.add.reduceat(cols, starts)
+    return stats
+
+
+def stitch_labels(edges, total, diagonal):
+    # connects labels that touch across a tile seam, label 0 stays a component of its own
+    pairs = []
+    for (i, j), (_, bottom, _, right) in edges.items():
+        for side, other in ((right, edges.get((i, j + 1), (None,) * 4)[2]), (bottom, edges.get((i + 1, j), (None,) * 4)[0])):
+            if other is None:
+                continue
+            pairs.append((side, other))
+            if diagonal:
+                pairs += [(side[1:], other[:-1]), (side[:-1], other[1:])]
+        if diagonal and (i + 1, j + 1) in edges:
+            pairs.append((bottom[-1:], edges[i + 1, j + 1][0][:1]))
+        if diagonal and (i + 1, j - 1) in edges:
+            pairs.append((bottom[:1], edges[i + 1, j - 1][0][-1:]))
+
+    first = np.concatenate([np.zeros(0, dtype=np.int64)] + [side for side, _ in pairs])
+    second = np.concatenate([np.zeros(0, dtype=np.int64)] + [other for _, other in pairs])
+    linked = (first > 0) & (second > 0)
+    graph = coo_matrix((np.ones(np.count_nonzero(linked), dtype=np.int8), (first[linked], second[linked])),
+                       shape=(total + 1, total + 1))
+    return connected_components(graph, directed=False)[1]
+
+
+def segmentation_arrays(shape, outlines, bboxes, centroids, masks):
+    # object masks are stored bbox local and packed back to back, see Sample.get_segmentation
+    return {'shape': np.asarray(shape),
+            'outlines': outlines,
+            'bboxes': np.array(bboxes, dtype=np.int64).reshape(-1, 4),
+            'centroids': np.array(centroids, dtype=np.float64).reshape(-1, 2),
+            'offsets': np.cumsum([0] + [len(mask) for mask in masks], dtype=np.int64),
+            'bits': np.concatenate([np.zeros(0, dtype=np.uint8)] + masks)}
+
+
+def extract_regions(label_img):
+    # groups all labelled pixels with one sort instead of scanning the image once per label
+    width = label_img.shape[1]
+    flat = label_img.ravel()
+    pixels = np.flatnonzero(flat)
+    if len(pixels) == 0:
+        return []
+
+    labels = flat[pixels]
+    order = np.argsort(labels, kind='stable')
+    pixels = pixels[order]
+    labels = labels[order]
+
+    starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+    counts = np.diff(np.r_[starts, len(pixels)])
+    rows, cols = np.divmod(pixels, width)
+
+    min_rows = np.minimum.reduceat(rows, starts)
+    max_rows = np.maximum.reduceat(rows, starts) + 1
+    min_cols = np.minimum.reduceat(cols, starts)
+    max_cols = np.maximum.reduceat(cols, starts) + 1
+    mean_rows = np.add.reduceat(rows, starts) / counts
+    mean_cols = np.add.reduceat(cols, starts) / counts
+
+    regions = []
+    for n, start in enumerate(starts):
+        end = start + counts[n]
+        regions.append(((rows[start:end], cols[start:end]),
+                        (min_rows[n], min_cols[n], max_rows[n], max_cols[n]),
+                        (mean_rows[n], mean_cols[n])))
+
+    return regions
+
+
+def label_digest(frozen, max_class):
+    # covers everything export_sample paints, names, zoom and centroids do not change a label image
+    digest = hashlib.sha1(repr(max_class).encode())
+    for obj in frozen:
+        digest.update(repr(int(obj['classtype'])).encode())
+        if obj['x'] is not None:
+            digest.update(b'x')
+            digest.update(np.asarray(obj['x'], dtype=np.float32).tobytes())
+            digest.update(np.asarray(obj['y'], dtype=np.float32).tobytes())
+        if obj['preseg'] is not None:
+            digest.update(repr((obj['preseg'].origin, tuple(obj['preseg'].shape))).encode())
+            digest.update(obj['preseg'].bits.tobytes())
+    return digest.hexdigest()
+
+
+def read_export_manifest(folder):
+    try:
+        with open(os.path.join(folder, export_manifest), 'r') as file:
+            return json.load(file)['labels']
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def write_export_manifest(folder, labels):
+    manifest = {'format': 'easylabelkit-export', 'version': 1, 'labels': labels}
+    write_atomic(os.path.join(folder, export_manifest), json.dumps(manifest, indent=1).encode())
+
+
+def paint_labels(label_img, objects, max_class, instance_img=None):
+    # the instance map is painted from the same pixels as the class map, later objects cover earlier ones
+    for n, obj in enumerate(objects):
+        value = 255 if max_class == 1 else obj['classtype'] + 1
+        if obj['x'] is not None and len(obj['x']) > 5:
+            x, y = polygon(obj['x'], obj['y'])
+            label_img[y, x] = value
+            if instance_img is not None:
+                instance_img[y, x] = n + 1
+        elif obj['preseg'] is not None:
+            row, col = obj['preseg'].origin
+            height, width = obj['preseg'].shape
+            local = obj['preseg'].local()
+            label_img[row:row + height, col:col + width][local] = value
+            if instance_img is not None:
+                instance_img[row:row + height, col:col + width][local] = n + 1
+
+
+def export_sample(path, shape, objects, max_class, previous, filename, instancename=None, sidecarname=None):
+    # runs in a pool process, one label image is rasterised, written and freed per call
+    if isinstance(objects, str):
+        objects = freeze_objects(load_objects(objects))
+    digest = label_digest(objects, max_class)
+    filenames = [f for f in (filename, instancename, sidecarname) if f is not None]
+    if digest == previous and all(os.path.isfile(f) for f in filenames):
+        return digest
+
+    if shape is None:
+        shape = open_image(path).shape
+    label_img = np.zeros(shape, dtype=np.uint8 if max_class <= 254 else np.uint16)
+    instance_img = None
+    if instancename is not None:
+        instance_img = np.zeros(shape[:2], dtype=np.uint16 if len(objects) < 2 ** 16 else np.uint32)
+    paint_labels(label_img, objects, max_class, instance_img)
+
+    if filename.endswith('.npy'):
+        np.save(filename, label_img)
+    else:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            imsave(filename, label_img)
+
+    if instancename is not None:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            imsave(instancename, instance_img)
+
+        # bbox and centroid describe the visible part of each instance, fully covered ones keep area 0
+        instances = [{'id': n + 1, 'name': obj['name'], 'class': int(obj['classtype']),
+                      'value': 255 if max_class == 1 else int(obj['classtype']) + 1,
+                      'area': 0, 'bbox': None, 'centroid': None} for n, obj in enumerate(objects)]
+        for (rows, cols), bbox, centroid in extract_regions(instance_img):
+            instance = instances[instance_img[rows[0], cols[0]] - 1]
+            instance['area'] = len(rows)
+            instance['bbox'] = [int(v) for v in bbox]
+            instance['centroid'] = [float(v) for v in centroid]
+
+        sidecar = {'image': os.path.basename(path), 'semantic': os.path.basename(filename),
+                   'instances': os.path.basename(instancename), 'objects': instances}
+        write_atomic(sidecarname, json.dumps(sidecar, indent=1).encode())
+
+    return digest
+
+
+def coco_annotations(path, name, shape, objects, image_id, first_id):
+    # runs in a pool process, returns the image entry and the annotations of one sample as json text
+    if shape is None:
+        shape = open_image(path).shape
+    height, width = shape[:2]
+    if isinstance(objects, str):
+        objects = freeze_objects(load_objects(objects))
+
+    annotations = []
+    for n, obj in enumerate(objects):
+        annotation = {'id': first_id + n, 'image_id': image_id, 'category_id': int(obj['classtype']) + 1, 'iscrowd': 0}
+        if obj['x'] is not None and len(obj['x']) > 5:
+            x = np.asarray(obj['x'], dtype=np.float64)
+            y = np.asarray(obj['y'], dtype=np.float64)
+            # area is the pixel count export_sample paints, taken from the polygon indices alone
+            area = len(polygon(x, y, shape=(width, height))[0])
+            left, top = max(x.min(), 0), max(y.min(), 0)
+            right, bottom = min(x.max(), width), min(y.max(), height)
+            annotation['segmentation'] = [np.round(np.stack([x, y], axis=1).ravel(), 2).tolist()]
+        elif obj['preseg'] is not None:
+            mask = obj['preseg']
+            local = mask.local()
+            rows = np.flatnonzero(local.any(axis=1))
+            cols = np.flatnonzero(local.any(axis=0))
+            if len(rows) == 0:
+                continue
+            area = int(np.count_nonzero(local))
+            top, bottom = mask.origin[0] + rows[0], mask.origin[0] + rows[-1] + 1
+            left, right = mask.origin[1] + cols[0], mask.origin[1] + cols[-1] + 1
+            counts = mask_rle(local, mask.origin, height, width)
+            annotation['segmentation'] = {'size': [int(height), int(width)], 'counts': rle_string(counts)}
+        else:
+            continue
+        annotation['area'] = area
+        annotation['bbox'] = [float(left), float(top), float(right - left), float(bottom - top)]
+        annotations.append(json.dumps(annotation))
+
+    image = {'id': image_id, 'file_name': name, 'width': int(width), 'height': int(height)}
+    return image, ',\n'.join(annotations)
+
+
+def mask_rle(local, origin, height, width):
+    # column major run lengths over the whole image, built from the bbox local mask only
+    padded = np.zeros((local.shape[1], local.shape[0] + 2), dtype=np.int8)
+    padded[:, 1:-1] = local.T
+    steps = np.diff(padded, axis=1)
+    starts = np.nonzero(steps == 1)
+    ends = np.nonzero(steps == -1)
+    if len(starts[0]) == 0:
+        return np.array([height * width], dtype=np.int64)
+
+    # every mask column is a contiguous stretch of its image column
+    starts = (starts[0] + origin[1]) * height + starts[1] + origin[0]
+    ends = (ends[0] + origin[1]) * height + ends[1] + origin[0]
+
+    # runs that continue from the bottom of one image column into the next are one run
+    joined = ends[:-1] == starts[1:]
+    starts = starts[np.r_[True, ~joined]]
+    ends = ends[np.r_[~joined, True]]
+
+    bounds = np.empty(2 * len(starts) + 2, dtype=np.int64)
+    bounds[0] = 0
+    bounds[1:-1:2] = starts
+    bounds[2:-1:2] = ends
+    bounds[-1] = height * width
+    counts = np.diff(bounds)
+    if counts[-1] == 0:
+        counts = counts[:-1]
+    return counts
+
+
+def rle_string(counts):
+    # the compressed counts string of the COCO api, 5 bits per character with deltas against counts[i - 2]
+    values = np.asarray(counts, dtype=np.int64).copy()
+    values[3:] -= counts[1:-2]
+    chars = []
+    active = np.ones(len(values), dtype=bool)
+    while active.any():
+        chunk = values & 0x1f
+        values = values >> 5
+        more = np.where(chunk & 0x10, values != -1, values != 0) & active
+        chars.append(np.where(active, chunk + 48 + 32 * more, 0))
+        active = more
+    chars = np.stack(chars, axis=1)
+    return chars[chars > 0].astype(np.uint8).tobytes().decode('ascii')
+
+
+def image_header(path):
+    # TIFF headers give shape and dtype without decoding, other formats are decoded once
+    if tifffile is not None and path.lower().endswith(('.tif', '.tiff')):
+        try:
+            with tifffile.TiffFile(path) as tif:
+                series = tif.series[0]
+                return tuple(int(v) for v in series.shape), series.dtype.str
+        except Exception:
+            pass
+    image = open_image(path)
+    return tuple(int(v) for v in image.shape), image.dtype.str
+
+
+def dataset_sample(path, shape, objects, max_class, imagefile, labelfile, slot):
+    # runs in a pool process, writes one image and its label map into their bucket slots
+    image = open_image(path)
+    if tuple(image.shape) != tuple(shape):
+        raise ValueError('Image ' + path + ' changed since its header was read.')
+    if isinstance(objects, str):
+        objects = freeze_objects(load_objects(objects))
+
+    # copied in row bands so memory mapped and tiled sources are never decoded whole
+    band = max(downsample_band // (int(np.prod(shape[1:])) * image.dtype.itemsize), 1)
+    images = np.load(imagefile, mmap_mode='r+')
+    for start in range(0, shape[0], band):
+        stop = min(start + band, shape[0])
+        images[slot, start:stop, :shape[1]] = image[start:stop]
+    images.flush()
+    del images, image
+
+    labels = np.load(labelfile, mmap_mode='r+')
+    paint_labels(labels[slot, :shape[0], :shape[1]], objects, max_class)
+    labels.flush()
+    return slot
+
+
+def build_sample(path, presegmentation=None, presegpath=None):
+    # runs in a pool process, the decoded image is not sent back
+    sample = Sample(path, presegmentation=presegmentation, presegpath=presegpath)
+    image_cache.discard(path)
+    return sample
+
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
@@ -0,0 +1,67 @@
+import warnings
+
+import numpy as np
+import tifffile
+
+import gui  # elk and gui import each other, gui has to be loaded first
+import elk
+
+
+def write_image(path):
+    image = np.full((64, 80), 10, dtype=np.uint8)
+    image[10:30, 12:40] = 200
+    image[40:55, 50:70] = 200
+    tifffile.imwrite(str(path), image)
+    return str(path)
+
+
+def unwritable_cache(tmp_path):
+    # a regular file where the cache folder should be, makedirs fails even for root
+    blocker = tmp_path / 'blocker'
+    blocker.write_bytes(b'')
+    return elk.PresegCache(str(blocker / 'cache'), 1 << 20)
+
+
+def test_load_from_missing_folder_is_a_miss(tmp_path):
+    cache = elk.PresegCache(str(tmp_path / 'missing'), 1 << 20)
+    assert cache.load('0' * 40) is None
+    assert cache.misses == 1
+
+
+def test_save_to_unwritable_folder_raises_oserror(tmp_path):
+    cache = unwritable_cache(tmp_path)
+    try:
+        cache.save('0' * 40, {'shape': np.array([1, 1])})
+    except OSError:
+        pass
+    else:
+        raise AssertionError('save into an unwritable folder did not fail')
+
+
+def test_sample_segments_without_a_writable_cache(tmp_path, monkeypatch):
+    path = write_image(tmp_path / 'image.tif')
+    monkeypatch.setattr(elk, 'preseg_cache', elk.PresegCache(str(tmp_path / 'cache'), 1 << 20))
+    cached = elk.Sample(path)
+    monkeypatch.setattr(elk, 'preseg_cache', unwritable_cache(tmp_path))
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        sample = elk.Sample(path)
+
+    assert sample.shape == (64, 80)
+    assert len(sample.objects) == len(cached.objects) > 0
+    assert any('could not be cached' in str(warning.message) for warning in caught)
+
+
+def test_deferred_sample_prepares_without_a_writable_cache(tmp_path, monkeypatch):
+    path = write_image(tmp_path / 'image.tif')
+    monkeypatch.setattr(elk, 'preseg_cache', unwritable_cache(tmp_path))
+
+    sample = elk.Sample(path, presegmentation=False)
+    sample.defer_segmentation()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        sample.prepare()
+
+    assert sample.pending is None
+    assert sample.outlines is not None